@@ -0,0 +1,445 @@
+"""Offline benchmarks for the dashboard's data loading and preparation
+
+Run with `python benchmark.py` (the modules read st.secrets on import, so
+.streamlit/secrets.toml must exist). Add --stages to run the end-to-end
+stages against the local stand-in servers in mock_servers.py, e.g.
+
+    python benchmark.py --stages --sizes 1000 10000 200000 --latency 0.05 --throttle-every 20
+"""
+import argparse, json, pickle, random, tempfile, time, tracemalloc
+from datetime import date, timedelta
+from pathlib import Path
+import pandas as pd
+import numpy as np
+import streamlit.logger
+import crunchbase as cb
+import http_client
+import powerhouse as ph
+import toggl
+import toggl_plot
+import mock_servers
+import frames
+import snapshots
+from box_store import BoxStore
+from round_store import RoundStore
+from org_cache import OrgCache
+
+def measure(func, *args, **kwargs):
+    """Run func once and return (result, seconds, peak MiB)"""
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, seconds, peak / 2**20
+
+def same_frames(left, right):
+    """Assert two frames hold the same values, treating None and NaN alike"""
+
+    normalize = lambda df: df.astype(object).where(df.notna(), None)
+    pd.testing.assert_frame_equal(normalize(left), normalize(right))
+
+def fake_organizations(n, seed=0):
+    """Generate n synthetic Crunchbase organization entities"""
+
+    r = random.Random(seed)
+    funding_types = list(cb.funding_types) + ['series_b', 'series_c', 'convertible_note']
+    cities = [('Oakland', 'California', 'United States'), ('Boston', 'Massachusetts', 'United States'),
+              ('Berlin', 'Berlin', 'Germany'), ('Nairobi', 'Nairobi County', 'Kenya')]
+
+    entities = []
+    for i in range(n):
+        p = {'identifier': {'value': f'Startup {i}'},
+             'permalink': f'startup-{i}',
+             'short_description': f'Startup {i} builds climate tech'}
+        if r.random() < .9:
+            p['website_url'] = f'https://startup{i}.com'
+        if r.random() < .8:
+            city, region, country = r.choice(cities)
+            p['location_identifiers'] = [
+                {'location_type': 'city', 'value': city},
+                {'location_type': 'region', 'value': region},
+                {'location_type': 'country', 'value': country}]
+        if r.random() < .7:
+            p['last_equity_funding_type'] = r.choice(funding_types)
+        if r.random() < .7:
+            p['funding_total'] = {'value_usd': r.choice([0, 5E5, 2E6, 8E6, 4E7])}
+        if r.random() < .5:
+            p['last_funding_at'] = '2024-05-01'
+        if r.random() < .3:
+            p['diversity_spotlights'] = [{'value': v} for v in 
+                                         r.sample(list(cb.diversity_lookup), r.randint(1, 3))]
+        if r.random() < .8:
+            p['categories'] = [{'value': f'Category {r.randint(0, 20)}'} for _ in range(r.randint(0, 3))]
+            p['category_groups'] = [{'value': f'Group {r.randint(0, 5)}'}]
+        if r.random() < .6:
+            p['founded_on'] = {'value': '2020-01-01'}
+        if r.random() < .7:
+            p['num_employees_enum'] = r.choice(list(cb.employees_dict))
+        entities.append({'uuid': str(i), 'properties': p})
+
+    return entities
+
+def fake_rounds(n, seed=0):
+    """Generate n synthetic Crunchbase funding round entities"""
+
+    r = random.Random(seed)
+    types = ['pre_seed', 'seed', 'series_a', 'series_b', 'grant', 'convertible_note']
+    money = lambda: {'value': r.randint(1, 50) * 1E5, 'currency': 'USD', 
+                     'value_usd': r.randint(1, 50) * 1E5}
+
+    entities = []
+    for i in range(n):
+        org = r.randint(0, n // 5)
+        p = {'identifier': {'uuid': f'round-{i}', 'value': f'Round {i}'},
+             'funded_organization_identifier': {'value': f'Startup {org}', 
+                                                'permalink': f'startup-{org}'},
+             'announced_on': f'20{r.randint(15, 24)}-{r.randint(1, 12):02}-{r.randint(1, 28):02}',
+             'created_at': '2024-06-01T00:00:00Z',
+             'updated_at': '2024-06-01T00:00:00Z',
+             'investment_type': r.choice(types),
+             'num_investors': r.randint(0, 5)}
+        if r.random() < .8:
+            p['money_raised'] = money()
+        if r.random() < .2:
+            p['post_money_valuation'] = money()
+        if r.random() < .1:
+            p['pre_money_valuation'] = money()
+        if p['num_investors']:
+            p['investor_identifiers'] = [{'value': f'Investor {r.randint(0, 500)}'} 
+                                         for _ in range(p['num_investors'])]
+        entities.append({'uuid': f'round-{i}', 'properties': p})
+
+    return entities
+
+def parse_rounds_rowwise(entities):
+    """The original per-row lambda normalization, kept for comparison"""
+
+    rounds = pd.DataFrame(r['properties'] for r in entities).reset_index(drop=True)
+
+    rounds['name'] = rounds['funded_organization_identifier'].dropna().map(lambda d: d['value'])
+    rounds['permalink'] = rounds['funded_organization_identifier'].map(lambda d: d['permalink'])
+    rounds['investor_names'] = rounds['investor_identifiers'].dropna().map(lambda l: [i['value'] for i in l])
+    rounds['announced_on'] = pd.to_datetime(rounds['announced_on'], errors='coerce')
+    rounds['usd_raised'] = rounds['money_raised'].dropna().map(lambda d: d['value_usd'])
+
+    rounds['post_money_value_usd'] = rounds['post_money_valuation'].dropna().map(lambda d: d['value_usd'])
+    rounds['pre_money_value_usd'] = rounds['pre_money_valuation'].dropna().map(lambda d: d['value_usd'])
+
+    rounds['url'] = 'https://www.crunchbase.com/organization/' + rounds['permalink'].str[:]
+
+    return rounds
+
+def bench_parse_rounds(n=50_000):
+    """Compare loading and normalizing stored rounds all at once vs in chunks"""
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = RoundStore(Path(tmp) / 'rounds.sqlite')
+        store.save(fake_rounds(n))
+
+        rows, row_s, row_mb = measure(lambda: parse_rounds_rowwise(store.load()))
+        cols, col_s, col_mb = measure(
+            lambda: pd.concat([cb.parse_rounds(c) for c in store.iter_load()], ignore_index=True))
+
+    same_frames(rows, cols[rows.columns])
+    per = 10_000 / n
+    print(f"parse_rounds (per 10k of {n:,} rounds): all at once {row_s * per:.2f}s / "
+          f"{row_mb:.0f} MiB peak, chunked {col_s * per:.2f}s / {col_mb:.0f} MiB peak")
+
+def bench_parse_organizations(n=10_000):
+    """Compare per-row parse_properties with the columnar parse_organizations"""
+
+    entities = fake_organizations(n)
+
+    rows, row_s, row_mb = measure(
+        lambda: pd.DataFrame([cb.parse_properties(e['properties']) for e in entities]))
+    cols, col_s, col_mb = measure(cb.parse_organizations, entities)
+
+    same_frames(rows, cols)
+    print(f"parse_organizations ({n:,} orgs): per-row {row_s:.2f}s / {row_mb:.0f} MiB, "
+          f"columnar {col_s:.2f}s / {col_mb:.0f} MiB ({row_s / col_s:.1f}x)")
+
+def fake_boxes_frame(n, seed=0):
+    """Generate a frame of n prepared Streak boxes with relationship columns"""
+
+    rng = np.random.default_rng(seed)
+    stages = ['Portfolio Company', 'Engaged', 'Lead', 'Out of Scope']
+
+    return pd.DataFrame({
+        'Stage': rng.choice(stages, n),
+        'callLogCount': rng.integers(0, 3, n),
+        'gmailThreadCount': rng.integers(0, 3, n),
+        'contacts': [[{'key': 'c'}] if c else None for c in rng.random(n) < .3],
+    })
+
+def fake_rounds_frame(n, seed=0):
+    """Generate a frame of n parsed rounds ready for the weekly digest"""
+
+    rng = np.random.default_rng(seed)
+    usd = rng.choice([np.nan, 0, 2.5E5, 1.25E6, 4.8E7], n)
+
+    return pd.DataFrame({
+        'name': [f'Startup {i}' for i in range(n)],
+        'Website': [f'https://startup{i}.com' for i in range(n)],
+        'usd_raised': usd,
+        'url': [f'https://www.crunchbase.com/organization/startup-{i}' for i in range(n)],
+        'investor_names': [[f'Investor {j}' for j in range(k)] if k >= 0 else None 
+                           for k in rng.integers(-1, 4, n)],
+    })
+
+def fake_projects_frame(n, seed=0):
+    """Generate a frame of n Toggl projects with derived rate columns"""
+
+    rng = np.random.default_rng(seed)
+    end_dates = pd.Series(pd.to_datetime('2024-01-01') + 
+                          pd.to_timedelta(rng.integers(0, 900, n), unit='D'))
+
+    return pd.DataFrame({
+        'fee_to_date': rng.random(n) * 2E6,
+        'Hours': rng.random(n) * 400,
+        'Effective $/hr': rng.random(n) * 600,
+        'end_date': end_dates.where(rng.random(n) < .9),
+    })
+
+# The original row-wise versions, kept for comparison
+
+def ph_contact_rowwise(row):
+    if row['Stage'] == 'Portfolio Company':
+        return 'PHV Portfolio'
+    elif row['callLogCount'] > 0 or row['Stage'] == 'Engaged':
+        return 'Interviewed'
+    elif type(row['contacts']) == list or row['gmailThreadCount'] > 0:
+        return 'Email contact'
+    else:
+        return 'Database-only'
+
+def simple_text_money_rowwise(f):
+    if f >= 1E6:
+        return f"\\${f/1E6:.1f}M"
+    elif f > 0:
+        return f"\\${f/1E3:.0f}k"
+    else:
+        return 'an undisclosed amount'
+
+def round_to_text_rowwise(row):
+    n = f"[{row['name']}]({row['Website']})"
+    r = f"[{simple_text_money_rowwise(row['usd_raised'])}]({row['url']})"
+    if type(row['investor_names']) == list:
+        return f"* {n} raised {r} from {', '.join(row['investor_names'])}"
+    else:
+        return f"* {n} raised {r}"
+
+def hovertext_rowwise(row):
+    f = f'Fee to date: ${row["fee_to_date"]:,.0f}'
+    h = f'Hours: {row["Hours"]:.0f}'
+    r = f'Effective rate: ${row["Effective $/hr"]:.0f}/hr'
+    e = f'End date: {row["end_date"]}'
+    return '<br>'.join([f,h,r,e])
+
+def bench_row_derivations(n=50_000):
+    """Compare apply(axis=1) derivations with their whole-column versions"""
+
+    cases = [('ph_contacts', fake_boxes_frame(n), ph_contact_rowwise, ph.ph_contacts),
+             ('rounds_to_text', fake_rounds_frame(n), round_to_text_rowwise, cb.rounds_to_text),
+             ('hovertexts', fake_projects_frame(n), hovertext_rowwise, toggl_plot.hovertexts)]
+
+    for name, frame, rowwise, columnar in cases:
+        start = time.perf_counter()
+        rows = frame.apply(rowwise, axis=1)
+        row_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cols = columnar(frame)
+        col_s = time.perf_counter() - start
+
+        assert rows.tolist() == pd.Series(cols).tolist(), name
+        print(f"{name} ({n:,} rows): apply {row_s:.2f}s, columnar {col_s:.3f}s "
+              f"({row_s / col_s:.0f}x)")
+
+def fake_pipeline(n, seed=0):
+    """Generate a Streak pipeline's (fields, stages, boxes) with n boxes
+
+    Websites and permalinks line up with fake_organizations and fake_rounds.
+    Like real boxes, some have no website (one in seven) and some no
+    Crunchbase permalink (one in three).
+    """
+
+    r = random.Random(seed)
+    tags = [{'key': f'tag{j}', 'tag': f'Tag {j}'} for j in range(12)]
+    items = [{'key': str(9000 + j), 'name': q} for j, q in enumerate(ph.qualities)]
+
+    fields = []
+    for i, name in enumerate(ph.startup_fields + ['permalink']):
+        field = {'key': str(1000 + i), 'name': name, 'type': 'TEXT_INPUT'}
+        if name in ('Focus', 'Primary Category', 'Thesis Sector'):
+            field.update(type='TAG', tagSettings={'tags': tags})
+        elif name in ('Quality Check', 'Funding Status'):
+            field.update(type='DROPDOWN', dropdownSettings={'items': items})
+        fields.append(field)
+
+    stages = {f's{j}': {'name': name} for j, name in 
+              enumerate(['Portfolio Company', 'Engaged', 'Lead', 'Out of Scope'])}
+
+    boxes = []
+    for i in range(n):
+        values = {}
+        for field in fields:
+            if field['type'] == 'TAG':
+                values[field['key']] = [t['key'] for t in r.sample(tags, r.randint(0, 3))]
+            elif field['type'] == 'DROPDOWN':
+                values[field['key']] = r.choice(items)['key']
+            elif field['name'] == 'Website':
+                if i % 7 != 6:
+                    values[field['key']] = f'https://startup{i}.com'
+            elif field['name'] == 'permalink':
+                if i % 3 != 2:
+                    values[field['key']] = f'https://www.crunchbase.com/organization/startup-{i}'
+            elif r.random() < .7:
+                values[field['key']] = f'{field["name"]} of startup {i}'
+        boxes.append({'key': f'box{i}', 'name': f'Startup {i}', 'stageKey': r.choice(list(stages)),
+                      'creationTimestamp': 1_600_000_000_000 + i * 1000,
+                      'lastUpdatedTimestamp': 1_700_000_000_000 + i * 1000, 'fields': values,
+                      'callLogCount': r.randint(0, 2), 'gmailThreadCount': r.randint(0, 2),
+                      'contacts': [{'key': 'c'}] if r.random() < .3 else None})
+
+    return fields, stages, boxes
+
+def fake_workspace(n, seed=0):
+    """Generate a Toggl workspace with n projects, their clients and time entries"""
+
+    r = random.Random(seed)
+    clients = [{'id': c, 'name': f'Client {c}'} for c in range(max(n // 10, 1))]
+
+    projects = []
+    for i in range(n):
+        start = date.today() - timedelta(days=r.randint(0, 500))
+        projects.append({'id': i, 'name': f'Project {i}', 'active': True,
+                         'client_id': r.choice(clients)['id'] if r.random() < .9 else None,
+                         'start_date': start.isoformat(),
+                         'end_date': (start + timedelta(days=r.randint(10, 400))).isoformat(),
+                         'fixed_fee': r.choice([None, 5E4, 1.2E5, 3E5]),
+                         'actual_hours': r.randint(0, 500)})
+
+    entries = []
+    for i in range(n * 20):
+        start = date(2023, 1, 1) + timedelta(days=r.randint(0, 600))
+        entries.append({'id': i, 'project_id': r.randint(0, n - 1),
+                        'start': f'{start.isoformat()}T09:00:00+00:00', 
+                        'stop': f'{start.isoformat()}T10:00:00+00:00',
+                        'seconds': r.randint(60, 8 * 3600)})
+    entries.sort(key=lambda e: e['start'])
+
+    return {'clients': clients, 'projects': projects, 'time_entries': entries}
+
+def bench_compaction(n=20_000):
+    """Compare memory and pickle round trips (what a cache read costs) before and after compact"""
+
+    fields, stages, boxes = fake_pipeline(n)
+    decoders = ph.compile_decoders(json.dumps(fields))
+    with mock_servers.StreakServer(fields, stages, boxes):
+        sn = ph.prepare_startup_network(ph.prepare_boxes(boxes), fields=ph.startup_fields, 
+                                        decoders=decoders)
+    rounds = cb.parse_rounds(fake_rounds(n))
+
+    cases = [('startup network', sn, lambda f: frames.compact(f, drop=ph.raw_box_columns)),
+             ('rounds', rounds, lambda f: frames.compact(f, drop=cb.raw_round_columns, 
+                                                         dates=['created_at', 'updated_at']))]
+
+    for name, frame, compact in cases:
+        compacted = compact(frame)
+        for label, f in [('before', frame), ('after', compacted)]:
+            start = time.perf_counter()
+            pickle.loads(pickle.dumps(f))
+            seconds = time.perf_counter() - start
+            print(f"{name} {label} compact ({n:,} rows): {frames.memory_per_10k(f):.1f} MiB "
+                  f"per 10k rows, pickle round trip {seconds:.3f}s")
+
+def run_stage(name, n, func, servers):
+    """Run one stage, print its time, requests and peak memory, and return its result"""
+
+    before = sum(s.requests for s in servers)
+    result, seconds, peak = measure(func)
+    requests = sum(s.requests for s in servers) - before
+
+    print(f"{name:<28} {n:>9,} {seconds:>9.2f}s {requests:>7} req {peak:>9.0f} MiB")
+    return result
+
+def bench_stages(n, latency=0, throttle_every=0):
+    """Run each loading stage end to end against local stand-in servers"""
+
+    mock = dict(latency=latency, throttle_every=throttle_every)
+    fields, stages, boxes = fake_pipeline(n)
+    workspace = fake_workspace(max(n // 100, 10))
+
+    servers = [mock_servers.StreakServer(fields, stages, boxes, **mock),
+               mock_servers.CrunchbaseServer(fake_organizations(n), fake_rounds(n), **mock),
+               mock_servers.TogglServer({toggl.workspace_id: workspace}, **mock)]
+
+    # The stand-ins only throttle with 429s, so don't hold requests to the live budgets
+    for service in ['crunchbase', 'streak']:
+        http_client.set_rate(service, None)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for server in servers:
+            server.start()
+        try:
+            box_store = BoxStore(Path(tmp) / 'boxes.sqlite')
+            sn = run_stage('get_startup_network cold', n, 
+                           lambda: ph.get_startup_network(box_store, fields=ph.startup_fields + ['permalink']), servers)
+            run_stage('get_startup_network warm', n, 
+                      lambda: ph.get_startup_network(box_store, fields=ph.startup_fields + ['permalink']), servers)
+
+            permalinks = snapshots.add_crunchbase_keys(sn)['permalink'].dropna().tolist()
+            store_path = Path(tmp) / 'rounds.sqlite'
+            run_stage('get_all_rounds cold', n, 
+                      lambda: cb.load_all_rounds(permalinks, store_path=store_path), servers)
+            run_stage('get_all_rounds warm', n, 
+                      lambda: cb.load_all_rounds(permalinks, store_path=store_path), servers)
+
+            websites = sn['Website'].head(1000).tolist()
+            org_cache = OrgCache(Path(tmp) / 'organizations.sqlite')
+            run_stage('match_startups cold (1k)', n, 
+                      lambda: cb.match_startups(websites, cache=org_cache), servers)
+            run_stage('match_startups warm (1k)', n, 
+                      lambda: cb.match_startups(websites, cache=org_cache), servers)
+
+            toggl.client_cache.clear()
+            projects = run_stage('toggl.get_projects', len(workspace['projects']), 
+                                 toggl.get_projects, servers)
+            with toggl_plot.figure_lock:
+                toggl_plot.figure_cache.clear()
+            run_stage('plot_projects', len(projects), 
+                      lambda: toggl_plot.plot_projects(projects), servers)
+        finally:
+            for server in servers:
+                server.stop()
+
+    throttled = sum(s.throttled for s in servers)
+    if throttled:
+        print(f"{'(429s injected)':<28} {n:>9,} {throttled:>18}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stages', action='store_true', 
+                        help='run end-to-end stages against local stand-in servers')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000],
+                        help='boxes and rounds to generate for each stage run')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each response')
+    parser.add_argument('--throttle-every', type=int, default=0, 
+                        help='answer every nth request with a 429')
+    args = parser.parse_args()
+
+    if args.stages:
+        # Outside `streamlit run` every st.* call logs a warning
+        streamlit.logger.set_log_level('error')
+        print(f"{'stage':<28} {'size':>9} {'time':>10} {'requests':>11} {'peak':>13}")
+        for n in args.sizes:
+            bench_stages(n, args.latency, args.throttle_every)
+    else:
+        bench_parse_organizations()
+        bench_parse_rounds()
+        bench_row_derivations()
+        bench_compaction()
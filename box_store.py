@@ -0,0 +1,79 @@
+import json
+from contextlib import closing
+from pathlib import Path
+import pandas as pd
+from sqlite_store import SQLiteStore, select_in
+
+default_path = Path(__file__).parent / 'data' / 'boxes.sqlite'
+
+schema = """
+CREATE TABLE IF NOT EXISTS boxes (
+    key TEXT PRIMARY KEY,
+    last_updated INTEGER,
+    box TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value
+);
+"""
+
+class BoxStore(SQLiteStore):
+    """On-disk copy of Streak boxes, keyed by box key
+
+    Alongside the raw boxes it keeps the lastUpdatedTimestamp watermark
+    and the last prepared frame built from them, so refreshes only need
+    to rebuild the changed rows.
+    """
+
+    def __init__(self, path=default_path):
+        self.frame_path = Path(path).with_suffix('.pkl')
+        super().__init__(path, schema)
+
+    def get_meta(self, name):
+        with closing(self.connect()) as db:
+            row = db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+            return row[0] if row else None
+
+    def timestamps(self):
+        """Return {box key: lastUpdatedTimestamp} for every stored box"""
+
+        with closing(self.connect()) as db:
+            return dict(db.execute("SELECT key, last_updated FROM boxes"))
+
+    def save(self, changed=(), deleted=(), **meta):
+        """Upsert changed boxes, drop deleted keys and update meta values"""
+
+        rows = [(b['key'], b['lastUpdatedTimestamp'], json.dumps(b)) for b in changed]
+
+        with closing(self.connect()) as db, db:
+            db.executemany("INSERT OR REPLACE INTO boxes VALUES (?, ?, ?)", rows)
+            db.executemany("DELETE FROM boxes WHERE key = ?", [(k,) for k in deleted])
+            db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", meta.items())
+
+    def iter_boxes(self, keys=None, chunk_size=1000):
+        """Yield stored boxes one at a time, optionally only those with the given keys"""
+
+        with closing(self.connect()) as db:
+            if keys is None:
+                rows = db.execute("SELECT box FROM boxes")
+                while chunk := rows.fetchmany(chunk_size):
+                    yield from (json.loads(b) for b, in chunk)
+                return
+
+            rows = select_in(db, "SELECT box FROM boxes WHERE key IN ({marks})", keys, chunk_size)
+            yield from (json.loads(b) for b, in rows)
+
+    def load(self):
+        """Return all stored boxes as a list of dicts"""
+
+        return list(self.iter_boxes())
+
+    def load_frame(self):
+        """Return the last prepared frame, or None if there isn't one"""
+
+        if self.frame_path.exists():
+            return pd.read_pickle(self.frame_path)
+
+    def save_frame(self, frame):
+        frame.to_pickle(self.frame_path)
@@ -1,58 +1,56 @@
-import requests, json, time
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from json import JSONDecodeError
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from random import random
 # from tqdm import tqdm
+import numpy as np
 import pandas as pd
 import powerhouse as ph
+import http_client
+import tracing
+from frames import compact
+from round_store import RoundStore, round_identifier
+from org_cache import OrgCache
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 cb_key = st.secrets.cb_key
 userkey = {'user_key': cb_key}
 
-def send_request(method, url, params, query=None):
-    """Send a requests to Crunchbase with backoff if we overload their server"""
+def send_request(method, path, params, query=None):
+    """Send a request to Crunchbase and return its JSON body
 
-    s = requests.Session()
-    retries = Retry(total=5, backoff_factor=2, 
-                    status_forcelist=[ 429, 500, 502, 503, 504 ],
-                    allowed_methods=["GET", "PUT", "POST"])
-    s.mount('https://', HTTPAdapter(max_retries=retries))
-    r = s.request(method, url, params=params, json=query)
+    Requests wait their turn within Crunchbase's rate limit (see
+    http_client.Scheduler); an error status raises requests.HTTPError and
+    a body that isn't JSON raises http_client.DecodeError.
+    """
 
-    try:
-        return json.loads(r.text)
-    except JSONDecodeError:
-        print(r.history)
-        print(r.headers)
-        time.sleep(10)
-        return r
-
-def match_startups(values, on_domain=True):
-    """Match startups by website or permalink to Crunchbase"""
+    r = http_client.request('crunchbase', method, path, params=params, json=query)
+    r.raise_for_status()
 
-    url = "https://api.crunchbase.com/api/v4/searches/organizations"
+    return http_client.decode('crunchbase', r)
 
-    if on_domain:
-        query_method = [
-            {
-                "type": "predicate",
-                "field_id": "website_url",
-                "operator_id": "domain_includes",
-                "values": [ph.find_domain(website) for website in values]
-            }
-        ]
-    else:
-        query_method = [
-            {
-                "type": "predicate",
-                "field_id": "identifier",
-                "operator_id": "includes",
-                "values": values
-            }
-        ]        
+def search_pages(path, query, page_size=1000):
+    """Yield pages of entities from a Crunchbase search, following the after_id cursor"""
+
+    query = dict(query, limit=page_size)
+
+    while True:
+        # A search always answers with 'entities'; anything else is an error, not the end
+        entities = send_request("POST", path, userkey, query)['entities']
+        if not entities:
+            return
+
+        yield entities
+
+        if len(entities) < page_size:
+            return
+        query = dict(query, after_id=entities[-1]['uuid'])
+
+def search_organizations(query_method):
+    """Return every organization matching a list of query predicates, newest first"""
+
+    path = "/searches/organizations"
 
     query = {
         "field_ids":[
@@ -70,22 +68,79 @@ def match_startups(values, on_domain=True):
             "field_id": "created_at",
             "sort": "desc"
             }
-        ],
-        "limit": 1000
+        ]
     }
     
-    data = send_request("POST", url, userkey, query)
+    return [e for page in search_pages(path, query) for e in page]
 
-    if type(data) is dict and 'count' in data.keys() and data['count'] > 0:
-        return data['entities']
+def search_domains(domains):
+    """Return {domain: newest organization entity or None} for a chunk of domains"""
 
-def match_startup(website):
-    """Match a single startup by website to Crunchbase"""
+    entities = search_organizations([
+        {
+            "type": "predicate",
+            "field_id": "website_url",
+            "operator_id": "domain_includes",
+            "values": domains
+        }
+    ])
+
+    found = {}
+    for e in entities:
+        website = e['properties'].get('website_url')
+        found.setdefault(ph.find_domain(website) if website else None, e)
+
+    return {domain: found.get(domain) for domain in domains}
+
+def match_domains(domains, cache=None, chunk_size=100, max_workers=4):
+    """Match domains to Crunchbase organizations, returning {domain: entity or None}
+
+    Domains are deduplicated, and only those without a fresh entry in the
+    OrgCache are searched, in chunks of chunk_size run by max_workers
+    threads. Every answer, including no match, is written back to the cache.
+    """
+
+    cache = cache or OrgCache()
+    domains = list(dict.fromkeys(d for d in domains if isinstance(d, str) and d))
+
+    matches = cache.get(domains)
+    stale = [d for d in domains if d not in matches]
+    chunks = [stale[i:i+chunk_size] for i in range(0, len(stale), chunk_size)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for found in pool.map(tracing.bind(search_domains), chunks):
+            cache.save(found)
+            matches.update(found)
+
+    return {domain: matches[domain] for domain in domains}
+
+def match_startups(values, on_domain=True, cache=None):
+    """Match startups by website or permalink to Crunchbase"""
+
+    if on_domain:
+        matches = match_domains(ph.find_domains(pd.Series(values, dtype=object)), cache)
+        entities = list({e['uuid']: e for e in matches.values() if e}.values())
+    else:
+        entities = search_organizations([
+            {
+                "type": "predicate",
+                "field_id": "identifier",
+                "operator_id": "includes",
+                "values": values
+            }
+        ])
 
-    entities = match_startups([website])
-    
     if entities:
-        return entities[0]['properties']
+        return entities
+
+def match_startup(website, cache=None):
+    """Match a single startup by website to Crunchbase"""
+
+    domain = ph.find_domain(website)
+    entity = match_domains([domain], cache).get(domain)
+
+    if entity:
+        return entity['properties']
 
 def parse_location(item):
 
@@ -251,20 +306,128 @@ def parse_properties(item):
     
     return pd.Series(output)
 
+def nested_values(column, *keys):
+    """Pull keys out of a column of dicts as plain columns, NaN where missing
+
+    Building a frame from the dicts unpacks them in one vectorized step.
+    """
+
+    present = column.dropna()
+    values = pd.DataFrame(present.tolist(), index=present.index, columns=list(keys))
+    values = values.reindex(column.index)
+
+    return values[keys[0]] if len(keys) == 1 else values
+
+def collect_values(column, key='value', agg=list, lookup=None):
+    """Collect `key` from each row's list of dicts with `agg`, None where missing"""
+
+    def collect(items):
+        values = [item[key] for item in items if item.get(key) is not None]
+        if lookup:
+            values = [lookup.get(v, np.nan) for v in values]
+        return agg(values)
+
+    present = column.dropna()
+    collected = pd.Series([collect(items) for items in present], index=present.index, dtype=object)
+
+    return collected.reindex(column.index).where(column.notna(), None)
+
+def parse_locations(props):
+    """Columnar parse_location: 'City, Region' (US) or 'City, Country'"""
+
+    locs = props['location_identifiers'].explode().dropna()
+    locs = pd.DataFrame(locs.tolist(), index=locs.index)
+    if locs.empty:
+        return pd.Series(None, index=props.index, dtype=object)
+
+    locs = (locs.reset_index().groupby(['index', 'location_type'])['value']
+                .first().unstack().reindex(index=props.index,
+                                           columns=['city', 'region', 'country']))
+
+    region = locs['region'].where(locs['country'] == 'United States', locs['country'])
+    location = locs['city'].where(region == '', locs['city'] + ', ' + region)
+
+    return location.where(locs.notna().all(axis=1), None).astype(object)
+
+def parse_fundings(props):
+    """Columnar parse_funding: status, last equity funding type and total"""
+
+    last_type = props['last_equity_funding_type']
+    status = last_type.map(funding_types)
+    later = last_type.str.contains('series', regex=False) & (last_type.str.len() == 8)
+    status = status.where(status.notna() | ~later.fillna(False).astype(bool), 'Series B or later')
+    status = status.fillna('Undisclosed')
+
+    funding_total = props['funding_total'].str.get('value_usd').astype(float)
+    funding_total = funding_total.where(funding_total > 0)
+
+    by_total = np.select([funding_total > funding_cutoffs[-1],
+                          funding_total > funding_cutoffs[-2],
+                          funding_total > funding_cutoffs[-3]],
+                         ['Series B or later', 'Series A', 'Seed'], 'Pre-Seed')
+    status = status.where((status != 'Undisclosed') | funding_total.isna(), 
+                          pd.Series(by_total, index=props.index))
+
+    return status, last_type.astype(object).where(last_type.notna(), None), funding_total
+
+org_fields = ['identifier', 'website_url', 'short_description', 'permalink',
+              'location_identifiers', 'last_equity_funding_type', 'funding_total',
+              'last_funding_at', 'diversity_spotlights', 'categories',
+              'category_groups', 'founded_on', 'num_employees_enum']
+
+def parse_organizations(entities):
+    """Parse organization entities (e.g. from match_startups) into a DataFrame
+
+    Columnar equivalent of building one parse_properties row per entity.
+    """
+
+    props = pd.DataFrame([e['properties'] for e in entities]).reindex(columns=org_fields)
+    props = props.astype(object).where(props.notna(), None)
+
+    funding_status, last_equity_funding_type, funding_total = parse_fundings(props)
+
+    columns = {
+        'name': props['identifier'].str.get('value'),
+        'website_url': props['website_url'],
+        'description': props['short_description'],
+        'permalink': props['permalink'],
+        'location': parse_locations(props),
+        'funding_status': funding_status,
+        'last_equity_funding_type': last_equity_funding_type,
+        'last_funding_at': props['last_funding_at'],
+        'funding_total': funding_total,
+        'diversity': collect_values(props['diversity_spotlights'], agg=set, 
+                                    lookup=diversity_lookup),
+        'categories': collect_values(props['categories']),
+        'category_groups': collect_values(props['category_groups']),
+        'founded_on': props['founded_on'].str.get('value'),
+        'num_employees': props['num_employees_enum'].map(employees_dict),
+    }
+
+    # Let pandas infer column dtypes the same way it does for the row-wise path
+    return pd.DataFrame({name: col.to_numpy(dtype=object) if col.dtype == object else col
+                         for name, col in columns.items()})
+
 def get_rounds(permalink):
     """Get funding rounds for a given permalink (organization)"""
 
-    url = f'https://api.crunchbase.com/api/v4/entities/organizations/{permalink}'
+    path = f'/entities/organizations/{permalink}'
     querystring = {"user_key":cb_key,
                    "card_ids":"raised_funding_rounds"}
 
-    return send_request("GET", url, querystring)
+    return send_request("GET", path, querystring)
 
-def get_many_rounds(identifiers, by="funded_organization_identifier"):
-    """Query CB for funding rounds for a list (up to 200) of identifiers"""
+def iter_many_rounds(identifiers, by="funded_organization_identifier",
+                     updated_since=None):
+    """Lazily yield pages of funding rounds for a list of identifiers
+
+    With updated_since (YYYY-MM-DD), only rounds updated on or after that
+    date are returned. A new round's updated_at is its created_at, so this
+    catches both new and edited rounds.
+    """
 
     query = {
-        "field_ids":["announced_on", "created_at",
+        "field_ids":["announced_on", "created_at", "updated_at",
                      "investment_type", "money_raised",
                      "pre_money_valuation","post_money_valuation",
                      "investor_identifiers","num_investors",
@@ -285,45 +448,180 @@ def get_many_rounds(identifiers, by="funded_organization_identifier"):
             "field_id": "created_at",
             "sort": "desc"
             }
-        ],
-        "limit": 1000
+        ]
     }
 
-    url = "https://api.crunchbase.com/api/v4/searches/funding_rounds"
-    return send_request("POST", url, userkey, query)
+    if updated_since:
+        query['query'].append({
+            "type": "predicate",
+            "field_id": "updated_at",
+            "operator_id": "gte",
+            "values": [updated_since]
+        })
 
-@st.cache_data(ttl='1d', show_spinner='Getting funding rounds (takes ~2m)')
-def get_all_rounds(permalinks, by="funded_organization_identifier"):
-    """Get and parse funding rounds for a list of an arbitrary number of permalinks"""
+    path = "/searches/funding_rounds"
+    return search_pages(path, query)
+
+def get_many_rounds(identifiers, by="funded_organization_identifier",
+                    updated_since=None):
+    """Query CB for all funding rounds for a list of identifiers"""
 
+    with tracing.span('get_all_rounds batch') as s:
+        pages = iter_many_rounds(identifiers, by, updated_since)
+        rounds = [r for page in pages for r in page]
+        s.rows = len(rounds)
+
+    return rounds
+
+def fetch_rounds(permalinks, by="funded_organization_identifier",
+                 batch_size=200, max_workers=4, updated_since=None):
+    """Fetch round entities for an arbitrary number of permalinks
+
+    Batches are fetched concurrently by `max_workers` threads, all drawing
+    on the shared Crunchbase request budget. Results keep batch order.
+    """
+
+    if not permalinks:
+        return []
+
+    # Background refreshes have no page to draw a progress bar on
     progress_text = "Loading rounds..."
-    bar = st.progress(0, text=progress_text)
+    bar = st.progress(0, text=progress_text) if get_script_run_ctx(suppress_warning=True) else None
+
+    batches = [permalinks[i:i+batch_size] for i in range(0, len(permalinks), batch_size)]
+    results = [None] * len(batches)
 
-    entities = []
+    # Only the main thread touches Streamlit; workers just fetch
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(tracing.bind(get_many_rounds), batch, by, updated_since): n 
+                   for n, batch in enumerate(batches)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            results[futures[future]] = future.result()
+            if bar:
+                bar.progress(done / len(batches), text=progress_text)
 
-    for i in range(0, len(permalinks), 200):
-        d = get_many_rounds(permalinks[i:i+200])
-        entities = entities + d['entities']
-        bar.progress((i/len(permalinks)), text=progress_text)
+    if bar:
+        time.sleep(1)
+        bar.empty()
 
-    time.sleep(1)
-    bar.empty()
+    return [e for batch in results for e in batch]
 
-    rounds = pd.DataFrame(r['properties'] for r in entities).reset_index(drop=True)
+def sync_rounds(permalinks, store, batch_size=200, max_workers=4):
+    """Bring the local round store up to date for the given permalinks
 
-    rounds['name'] = rounds['funded_organization_identifier'].dropna().map(lambda d: d['value'])
-    rounds['permalink'] = rounds['funded_organization_identifier'].map(lambda d: d['permalink'])
-    rounds['investor_names'] = rounds['investor_identifiers'].dropna().map(lambda l: [i['value'] for i in l])
+    New permalinks get their full history; permalinks synced before only
+    fetch rounds updated since their last sync.
+    """
+
+    synced_on = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    watermarks = store.watermarks()
+
+    new = [p for p in permalinks if p not in watermarks]
+    entities = fetch_rounds(new, batch_size=batch_size, max_workers=max_workers)
+    store.save(entities, synced=new, synced_on=synced_on)
+
+    stale = {}
+    for p in permalinks:
+        if p in watermarks:
+            stale.setdefault(watermarks[p], []).append(p)
+
+    for since, group in stale.items():
+        entities = fetch_rounds(group, batch_size=batch_size,
+                                max_workers=max_workers, updated_since=since)
+        store.save(entities, synced=group, synced_on=synced_on)
+
+@st.cache_data(ttl='1d', show_spinner='Getting funding rounds...')
+def get_all_rounds(permalinks, by="funded_organization_identifier",
+                   batch_size=200, max_workers=4, store_path=None):
+    """Get and parse funding rounds for a list of an arbitrary number of permalinks"""
+
+    return load_all_rounds(permalinks, by, batch_size, max_workers, store_path)
+
+def load_all_rounds(permalinks, by="funded_organization_identifier",
+                    batch_size=200, max_workers=4, store_path=None):
+    """Uncached get_all_rounds, e.g. for refreshing ahead of the cache
+
+    Rounds by funded organization are kept in a local RoundStore and only
+    refreshed incrementally; other lookups are fetched in full. The parsed
+    frame is compacted (see frames.compact) without the raw nested columns.
+    """
+
+    with tracing.span('get_all_rounds') as s:
+        if by == "funded_organization_identifier":
+            store = RoundStore(store_path) if store_path else RoundStore()
+            sync_rounds(permalinks, store, batch_size, max_workers)
+            chunks = store.iter_load(permalinks)
+        else:
+            chunks = [fetch_rounds(permalinks, by, batch_size, max_workers)]
+
+        with tracing.span('parse_rounds') as p:
+            frames = [parse_rounds(chunk) for chunk in chunks if chunk]
+            rounds = pd.concat(frames, ignore_index=True) if frames else parse_rounds([])
+            rounds = compact(rounds, drop=raw_round_columns, 
+                             dates=['created_at', 'updated_at'])
+            p.rows = s.rows = len(rounds)
+
+    return rounds
+
+# Columns parse_rounds always returns, even when no round (or no rounds at all) has them
+round_nested = ['funded_organization_identifier', 'investor_identifiers', 'money_raised',
+                'pre_money_valuation', 'post_money_valuation', 'announced_on',
+                'created_at', 'updated_at', 'investment_type', 'num_investors']
+
+# Nested columns whose values parse_rounds flattens, dropped when compacting
+raw_round_columns = ['identifier', 'funded_organization_identifier', 'investor_identifiers', 
+                     'money_raised', 'pre_money_valuation', 'post_money_valuation']
+
+def parse_rounds(entities):
+    """Parse funding round entities into a DataFrame with flattened columns"""
+
+    rounds = pd.DataFrame([r['properties'] for r in entities])
+    rounds['uuid'] = pd.Series([round_identifier(r) for r in entities], dtype=object)
+    for col in round_nested:
+        if col not in rounds:
+            rounds[col] = pd.Series(None, index=rounds.index, dtype=object)
+
+    org = nested_values(rounds['funded_organization_identifier'], 'value', 'permalink')
+    rounds['name'] = org['value']
+    rounds['permalink'] = org['permalink']
+    rounds['investor_names'] = collect_values(rounds['investor_identifiers'])
     rounds['announced_on'] = pd.to_datetime(rounds['announced_on'], errors='coerce')
-    rounds['usd_raised'] = rounds['money_raised'].dropna().map(lambda d: d['value_usd'])
+    rounds['usd_raised'] = nested_values(rounds['money_raised'], 'value_usd')
 
-    rounds['post_money_value_usd'] = rounds['post_money_valuation'].dropna().map(lambda d: d['value_usd'])
-    rounds['pre_money_value_usd'] = rounds['pre_money_valuation'].dropna().map(lambda d: d['value_usd'])
+    rounds['post_money_value_usd'] = nested_values(rounds['post_money_valuation'], 'value_usd')
+    rounds['pre_money_value_usd'] = nested_values(rounds['pre_money_valuation'], 'value_usd')
 
-    rounds['url'] = 'https://www.crunchbase.com/organization/' + rounds['permalink'].str[:]
+    rounds['url'] = 'https://www.crunchbase.com/organization/' + rounds['permalink']
 
     return rounds
 
+def as_text(column):
+    """Format each value of a column with str(), like an f-string would"""
+
+    return column.to_numpy(dtype=object).astype(str)
+
+def simple_text_money(usd):
+    """Convert large dollar amounts to $M or $k"""
+
+    usd = usd.to_numpy(dtype=float)
+    millions = '\\$' + np.char.mod('%.1f', usd / 1E6) + 'M'
+    thousands = '\\$' + np.char.mod('%.0f', usd / 1E3) + 'k'
+
+    return np.select([usd >= 1E6, usd > 0], [millions, thousands], 'an undisclosed amount')
+
+def rounds_to_text(rounds):
+    """Convert raise info to one descriptive markdown line per round"""
+
+    n = '[' + as_text(rounds['name']) + '](' + as_text(rounds['Website']) + ')'
+    r = '[' + simple_text_money(rounds['usd_raised']) + '](' + as_text(rounds['url']) + ')'
+    text = pd.Series('* ' + n + ' raised ' + r, index=rounds.index)
+
+    is_list = rounds['investor_names'].map(type) == list
+    # Filled in so text + investors stays a str op when no round has investors
+    investors = rounds['investor_names'].where(is_list).str.join(', ').fillna('').astype(str)
+
+    return text.where(~is_list, text + ' from ' + investors)
+
 def get_investors(data):
     rounds = data['cards']['raised_funding_rounds']
 
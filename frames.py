@@ -0,0 +1,98 @@
+import json
+import pandas as pd
+import pyarrow as pa
+
+def compact(frame, drop=(), dates=(), max_share=0.5):
+    """Return a copy of frame that takes less memory
+
+    Drops the `drop` columns (e.g. raw nested values already flattened),
+    parses the `dates` columns to UTC datetimes (columns missing from
+    either are skipped), stores columns of Python strings with the
+    Arrow-backed str dtype, and turns string columns with at most
+    max_share distinct values per row into categoricals.
+    """
+
+    frame = frame.drop(columns=[c for c in drop if c in frame])
+
+    for col in [c for c in dates if c in frame]:
+        frame[col] = pd.to_datetime(frame[col], errors='coerce', utc=True)
+
+    for col in frame.columns:
+        values = frame[col]
+        if values.dtype == object and pd.api.types.infer_dtype(values, skipna=True) == 'string':
+            values = values.astype('str')
+        if isinstance(values.dtype, pd.StringDtype):
+            if values.nunique() <= max_share * len(values):
+                values = values.astype('category')
+        frame[col] = values
+
+    return frame
+
+def memory_per_10k(frame):
+    """Return a frame's deep memory use in MiB per 10k rows"""
+
+    return frame.memory_usage(deep=True).sum() / 2**20 * 10_000 / max(len(frame), 1)
+
+def column_kind(values):
+    """Return how a column needs storing in Arrow: 'sparse', 'list', 'json' or None"""
+
+    if isinstance(values.dtype, pd.SparseDtype):
+        return 'sparse'
+    if values.dtype != object:
+        return None
+
+    types = set(values.dropna().map(type))
+    if types == {list} and all(type(v) is str for l in values.dropna() for v in l):
+        return 'list'
+    if len(types) <= 1 and types <= {str, bool, int, float}:
+        return None
+    # Dicts, lists of dicts and mixed values round-trip as JSON text
+    return 'json'
+
+def write_frame(frame, path):
+    """Write a frame to an Arrow IPC file that read_frame restores exactly
+
+    Arrow has no sparse columns and reads lists back as arrays, so such
+    columns are stored plainly and their kind is kept in the file's schema
+    metadata.
+    """
+
+    kinds = {}
+    columns = {}
+    for col in frame.columns:
+        values = frame[col]
+        kind = column_kind(values)
+        if kind == 'sparse':
+            values = values.sparse.to_dense()
+        elif kind == 'json':
+            values = values.map(json.dumps, na_action='ignore')
+        if kind:
+            kinds[col] = kind
+        columns[col] = values
+
+    table = pa.Table.from_pandas(pd.DataFrame(columns, index=frame.index))
+    metadata = dict(table.schema.metadata or {}, frames=json.dumps(kinds))
+    table = table.replace_schema_metadata(metadata)
+
+    with pa.OSFile(str(path), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+def read_frame(path):
+    """Memory-map an Arrow IPC file written by write_frame and return the frame"""
+
+    with pa.memory_map(str(path)) as source:
+        table = pa.ipc.open_file(source).read_all()
+    kinds = json.loads(table.schema.metadata.get(b'frames', b'{}'))
+    frame = table.to_pandas()
+
+    for col, kind in kinds.items():
+        values = frame[col]
+        if kind == 'sparse':
+            frame[col] = pd.arrays.SparseArray(values.to_numpy(dtype=bool), fill_value=False)
+        else:
+            # Missing lists and JSON values come back as None
+            values = values.astype(object).where(values.notna(), None)
+            frame[col] = values.map(list if kind == 'list' else json.loads, na_action='ignore')
+
+    return frame
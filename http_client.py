@@ -0,0 +1,303 @@
+import codecs, json, os, threading, time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import tracing
+
+# One long-lived Session per service, so repeated calls reuse warm connections.
+# Set e.g. CRUNCHBASE_BASE_URL=http://localhost:8000 (or call set_base_url)
+# to point a service at a local stand-in server. 'rate' is the service's
+# request budget, shared by every thread; 429s are left to the Scheduler
+# rather than urllib3, so one throttled request holds back all the others.
+services = {
+    'crunchbase': {
+        'base_url': 'https://api.crunchbase.com/api/v4',
+        # Crunchbase allows 200 calls per minute per key
+        'rate': dict(calls=200, period=60),
+        'retry': dict(total=5, backoff_factor=2,
+                      status_forcelist=[ 500, 502, 503, 504 ],
+                      allowed_methods=["GET", "PUT", "POST"]),
+    },
+    'streak': {
+        'base_url': 'https://www.streak.com/api',
+        'rate': dict(calls=10, period=1),
+        'retry': dict(total=5, backoff_factor=1,
+                      status_forcelist=[ 500, 502, 503, 504 ]),
+    },
+    'toggl': {
+        'base_url': 'https://api.track.toggl.com/api/v9',
+        'retry': dict(total=3, backoff_factor=1,
+                      status_forcelist=[ 500, 502, 503, 504 ]),
+    },
+    'toggl_reports': {
+        'base_url': 'https://api.track.toggl.com/reports/api/v3',
+        'retry': dict(total=3, backoff_factor=1,
+                      status_forcelist=[ 500, 502, 503, 504 ],
+                      allowed_methods=["GET", "POST"]),
+    },
+}
+
+for name, service in services.items():
+    service['base_url'] = os.environ.get(f'{name.upper()}_BASE_URL', service['base_url'])
+
+pool_maxsize = 16
+
+# How many times one request is sent again after a 429
+max_throttled = 5
+
+_sessions = {}
+_schedulers = {}
+_lock = threading.Lock()
+
+class DecodeError(ValueError):
+    """A response whose body isn't the JSON we asked for"""
+
+    def __init__(self, service, response, text=None):
+        self.service = service
+        self.status_code = response.status_code
+        self.url = response.url
+        # A streamed body has been read already, so the caller passes what's left
+        self.text = (response.text if text is None else text)[:200]
+        super().__init__(f'{service} sent undecodable {response.status_code} '
+                         f'from {response.url}: {self.text!r}')
+
+class Scheduler:
+    """Hand out a service's requests in turn, within its rate and Retry-After
+
+    A token bucket holding up to `burst` tokens, refilled at
+    (calls - burst)/period per second, so no stretch of `period` seconds
+    can send more than `calls` requests, not even a burst from a full
+    bucket plus its refill. By default a burst is a twentieth of the
+    budget. Each request takes a token; when none is left, it is given
+    the next free slot, so waiting requests go out in the order they
+    asked, spaced evenly rather than all at once. A 429 or an exhausted
+    rate-limit header pauses the whole service until the server says to
+    resume. With calls=None there is no budget, only the pauses.
+    """
+
+    def __init__(self, calls=None, period=60, burst=None):
+        self.calls = calls
+        self.period = period
+        self.burst = calls // 20 if calls and burst is None else burst
+        self.rate = (calls - self.burst) / period if calls else None
+        self.tokens = self.burst or 0
+        self.updated = time.monotonic()
+        self.paused_until = 0.
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        # After a pause, the bucket only starts refilling when it ends
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self):
+        """Wait for this request's turn; return how long that took"""
+
+        start = time.monotonic()
+        with self.lock:
+            ready = start
+            if self.calls:
+                self.refill(start)
+                # Tokens can go negative: that's the queue of requests waiting
+                self.tokens -= 1
+                ready = self.updated + max(-self.tokens, 0) / self.rate
+
+        while True:
+            with self.lock:
+                wait = max(ready, self.paused_until) - time.monotonic()
+            if wait <= 0:
+                return time.monotonic() - start
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold every request for the service for at least `seconds`"""
+
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + seconds)
+            if self.calls:
+                # Start refilling from empty once the pause ends
+                self.refill(now)
+                self.tokens = min(self.tokens, 0)
+                self.updated = max(self.updated, self.paused_until)
+
+def header_seconds(value):
+    """Read a Retry-After or rate-limit reset header as seconds from now"""
+
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
+
+    # Some servers send the reset as a Unix timestamp rather than a delay
+    if seconds > 1e9:
+        seconds -= time.time()
+    return max(seconds, 0)
+
+def throttled_for(response):
+    """Return how long the server asks us to wait before the next request, if at all"""
+
+    headers = response.headers
+    if response.status_code == 429 or headers.get('Retry-After'):
+        return header_seconds(headers.get('Retry-After'))
+
+    for prefix in ['X-RateLimit-', 'RateLimit-']:
+        remaining = headers.get(prefix + 'Remaining')
+        if remaining is not None and remaining.strip() == '0':
+            return header_seconds(headers.get(prefix + 'Reset'))
+
+def base_url(service):
+    """Return the base URL for a service"""
+
+    return services[service]['base_url'].rstrip('/')
+
+def set_base_url(service, url):
+    """Point a service at a different server (e.g. a local stand-in)"""
+
+    services[service]['base_url'] = url
+    close(service)
+
+def set_rate(service, calls=None, period=60):
+    """Change a service's request budget; calls=None lifts it"""
+
+    with _lock:
+        services[service]['rate'] = dict(calls=calls, period=period)
+        _schedulers.pop(service, None)
+
+def get_scheduler(service):
+    """Return the Scheduler shared by every request to a service"""
+
+    with _lock:
+        if service not in _schedulers:
+            _schedulers[service] = Scheduler(**services[service].get('rate', {}))
+        return _schedulers[service]
+
+def get_session(service):
+    """Return the shared Session for a service, creating it on first use"""
+
+    with _lock:
+        if service not in _sessions:
+            s = requests.Session()
+            # Retry-After is the Scheduler's to honor, for every thread at once
+            retry = Retry(**services[service]['retry'], respect_retry_after_header=False)
+            adapter = HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry)
+            s.mount('https://', adapter)
+            s.mount('http://', adapter)
+            _sessions[service] = s
+        return _sessions[service]
+
+def request(service, method, path, **kwargs):
+    """Send a request to `path` on a service using its pooled Session
+
+    The request waits its turn in the service's Scheduler. A 429 pauses
+    the service for its Retry-After (or an exponential backoff if it has
+    none) and the request is sent again, up to max_throttled times, after
+    which requests.HTTPError is raised rather than the 429 returned. The
+    request, its retries and the bytes received are counted against any
+    open tracing spans; time spent paused counts as retry time.
+    """
+
+    s = get_session(service)
+    scheduler = get_scheduler(service)
+
+    for attempt in range(max_throttled + 1):
+        waited = scheduler.acquire()
+        if attempt:
+            tracing.record(retries=1, retry_seconds=waited)
+
+        start = time.perf_counter()
+        response = s.request(method, base_url(service) + path, **kwargs)
+        tracing.record_response(response, time.perf_counter() - start, 
+                                streamed=kwargs.get('stream', False))
+
+        wait = throttled_for(response)
+        if wait is None and response.status_code == 429:
+            wait = 2 ** attempt
+        if wait is not None:
+            scheduler.pause(wait)
+        if response.status_code != 429 or attempt == max_throttled:
+            break
+        response.close()
+
+    if response.status_code == 429:
+        response.close()
+        response.raise_for_status()
+
+    return response
+
+def decode(service, response):
+    """Return a response's JSON body, raising DecodeError if it has none"""
+
+    try:
+        return response.json()
+    except ValueError:
+        raise DecodeError(service, response) from None
+
+# Characters that can continue a JSON number
+number_chars = frozenset('0123456789.eE+-')
+
+def iter_json_array(service, response, chunk_bytes=2**16):
+    """Yield the items of a JSON array body one at a time, as it streams in
+
+    Send the request with stream=True, so only the unparsed tail of the
+    body is held in memory rather than the whole text. Bytes are counted
+    against any open tracing spans as they are read. A body that isn't a
+    complete JSON array raises DecodeError.
+    """
+
+    def read():
+        for raw in response.iter_content(chunk_bytes):
+            tracing.record(bytes=len(raw))
+            yield raw
+
+    decoder = json.JSONDecoder()
+    text = codecs.iterdecode(read(), response.encoding or 'utf-8')
+    buffer, pos, opened = '', 0, False
+
+    for chunk in text:
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not opened:
+                if buffer[pos] != '[':
+                    raise DecodeError(service, response, buffer[pos:])
+                opened = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Most likely the item isn't all here yet
+                break
+            if end == len(buffer) or buffer[end] in number_chars:
+                # A number may be cut short (12 of 123, 45 of 45.6, 1 of 1e5) until
+                # something that can't continue it follows
+                break
+            pos = end
+            yield item
+
+    raise DecodeError(service, response, buffer[pos:])
+
+def close(service=None):
+    """Close pooled connections for one service, or all of them"""
+
+    with _lock:
+        for name in ([service] if service else list(_sessions)):
+            s = _sessions.pop(name, None)
+            if s is not None:
+                s.close()
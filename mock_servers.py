@@ -0,0 +1,223 @@
+"""Local stand-ins for the Crunchbase, Streak and Toggl APIs
+
+Each server answers the endpoints the dashboard calls from in-memory
+synthetic data, optionally adding latency and throttling every nth
+request with a 429, and counts the requests it serves. start() points
+http_client at the server, so the unmodified client code talks to it.
+"""
+import json, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import http_client
+import powerhouse as ph
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def respond(self, method):
+        mock = self.server.mock
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        if mock.count():
+            status, payload, headers = 429, {'error': 'throttled'}, {'Retry-After': str(mock.retry_after)}
+        else:
+            status, headers = 200, {}
+            payload = mock.handle(method, url.path, parse_qs(url.query), body)
+            if type(payload) is tuple:
+                payload, headers = payload
+            if payload is None:
+                status, payload = 404, {'error': 'not found'}
+
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class MockServer:
+    """A threaded local HTTP server standing in for one or more services
+
+    latency is added to every response; with throttle_every=n, every nth
+    request gets a 429 with a Retry-After of retry_after seconds.
+    """
+
+    services = ()
+
+    def __init__(self, latency=0, throttle_every=0, retry_after=0):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def count(self):
+        """Count a request and return whether it should be throttled"""
+
+        with self.lock:
+            self.requests += 1
+            throttle = self.throttle_every and self.requests % self.throttle_every == 0
+            self.throttled += bool(throttle)
+            return throttle
+
+    def handle(self, method, path, query, body):
+        """Return the JSON payload (and optionally headers) for a request, or None"""
+
+        raise NotImplementedError
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        for service in self.services:
+            http_client.set_base_url(service, f'http://127.0.0.1:{self.server.server_port}')
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for service in self.services:
+            http_client.close(service)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def after(entities, after_id, limit):
+    """Return the page of entities following the one with uuid after_id"""
+
+    start = 0
+    if after_id:
+        start = next(i for i, e in enumerate(entities) if e['uuid'] == after_id) + 1
+    return entities[start:start + limit]
+
+class CrunchbaseServer(MockServer):
+    """Serves searches/organizations and searches/funding_rounds"""
+
+    services = ('crunchbase',)
+
+    def __init__(self, organizations=(), rounds=(), **kwargs):
+        super().__init__(**kwargs)
+        self.by_domain, self.by_permalink, self.rounds_by_org = {}, {}, {}
+
+        for org in organizations:
+            props = org['properties']
+            self.by_permalink[props['permalink']] = org
+            if props.get('website_url'):
+                self.by_domain.setdefault(ph.find_domain(props['website_url']), []).append(org)
+
+        for r in rounds:
+            permalink = r['properties']['funded_organization_identifier']['permalink']
+            self.rounds_by_org.setdefault(permalink, []).append(r)
+
+    def handle(self, method, path, query, body):
+        predicates = {p['field_id']: p['values'] for p in body['query']}
+
+        if path == '/searches/organizations':
+            if 'website_url' in predicates:
+                found = [o for d in predicates['website_url'] for o in self.by_domain.get(d, [])]
+            else:
+                found = [self.by_permalink[p] for p in predicates['identifier']
+                         if p in self.by_permalink]
+
+        elif path == '/searches/funding_rounds':
+            found = [r for p in predicates['funded_organization_identifier']
+                     for r in self.rounds_by_org.get(p, [])]
+            if 'updated_at' in predicates:
+                since = predicates['updated_at'][0]
+                found = [r for r in found if r['properties']['updated_at'][:10] >= since]
+
+        else:
+            return
+
+        entities = after(found, body.get('after_id'), body.get('limit', 100))
+        return {'count': len(found), 'entities': entities}
+
+class StreakServer(MockServer):
+    """Serves a pipeline's fields, stages and (paged) boxes"""
+
+    services = ('streak',)
+
+    def __init__(self, fields=(), stages=None, boxes=(), **kwargs):
+        super().__init__(**kwargs)
+        self.fields = list(fields)
+        self.stages = stages or {}
+        self.boxes = {b['key']: b for b in boxes}
+
+    def handle(self, method, path, query, body):
+        match = re.fullmatch(r'/v1/pipelines/[^/]+/(fields|stages|boxes)', path)
+        if not match:
+            return
+
+        resource = match.group(1)
+        if resource == 'fields':
+            return self.fields
+        if resource == 'stages':
+            return self.stages
+
+        boxes = list(self.boxes.values())
+        if 'page' not in query:
+            return boxes
+
+        boxes.sort(key=lambda b: -b['lastUpdatedTimestamp'])
+        limit, page = int(query['limit'][0]), int(query['page'][0])
+        return {'results': boxes[page * limit:(page + 1) * limit],
+                'hasNextPage': (page + 1) * limit < len(boxes)}
+
+class TogglServer(MockServer):
+    """Serves workspace clients and projects, and the time entries report"""
+
+    services = ('toggl', 'toggl_reports')
+
+    def __init__(self, workspaces=None, **kwargs):
+        super().__init__(**kwargs)
+        self.workspaces = workspaces or {}
+
+    def handle(self, method, path, query, body):
+        match = re.fullmatch(r'/workspaces/(\d+)/(clients|projects)', path)
+        if match:
+            workspace = self.workspaces.get(int(match.group(1)), {})
+            items = workspace.get(match.group(2), [])
+            # Like Toggl, clients ignore paging and always come back whole
+            if match.group(2) == 'clients':
+                return items
+            page, per_page = int(query['page'][0]), int(query['per_page'][0])
+            return items[(page - 1) * per_page:page * per_page]
+
+        match = re.fullmatch(r'/workspace/(\d+)/search/time_entries', path)
+        if match:
+            entries = self.workspaces.get(int(match.group(1)), {}).get('time_entries', [])
+            entries = [e for e in entries if body['start_date'] <= e['start'][:10] <= body['end_date']]
+
+            first, size = body.get('first_row_number', 1) - 1, body['page_size']
+            rows = [{'project_id': e['project_id'],
+                     'time_entries': [{k: v for k, v in e.items() if k != 'project_id'}]}
+                    for e in entries[first:first + size]]
+
+            headers = {}
+            if first + size < len(entries):
+                headers = {'X-Next-ID': str(entries[first + size]['id']),
+                           'X-Next-Row-Number': str(first + size + 1)}
+            return rows, headers
@@ -0,0 +1,54 @@
+import json
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from sqlite_store import SQLiteStore, select_in
+
+default_path = Path(__file__).parent / 'data' / 'organizations.sqlite'
+
+schema = """
+CREATE TABLE IF NOT EXISTS matches (
+    domain TEXT PRIMARY KEY,
+    organization TEXT,
+    checked_on TEXT
+);
+"""
+
+class OrgCache(SQLiteStore):
+    """On-disk cache of which Crunchbase organization (if any) has a domain
+
+    Domains with no organization are cached too, for a shorter time, since
+    a startup may be added to Crunchbase after we first looked.
+    """
+
+    def __init__(self, path=default_path, ttl=timedelta(days=30),
+                 negative_ttl=timedelta(days=7)):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        super().__init__(path, schema)
+
+    def get(self, domains):
+        """Return {domain: organization entity or None} for fresh cached domains"""
+
+        now = datetime.now(timezone.utc)
+        found = {}
+
+        with closing(self.connect()) as db:
+            rows = select_in(db, "SELECT domain, organization, checked_on FROM matches "
+                                 "WHERE domain IN ({marks})", domains)
+            for domain, organization, checked_on in rows:
+                ttl = self.ttl if organization else self.negative_ttl
+                if now - datetime.fromisoformat(checked_on) < ttl:
+                    found[domain] = json.loads(organization) if organization else None
+
+        return found
+
+    def save(self, matches):
+        """Cache {domain: organization entity or None}, checked now"""
+
+        checked_on = datetime.now(timezone.utc).isoformat()
+        rows = [(domain, json.dumps(org) if org else None, checked_on)
+                for domain, org in matches.items()]
+
+        with closing(self.connect()) as db, db:
+            db.executemany("INSERT OR REPLACE INTO matches VALUES (?, ?, ?)", rows)
@@ -1,14 +1,18 @@
 import streamlit as st
 import io, re
-import requests, json
+import json, hashlib
+from functools import lru_cache
+from itertools import islice
+import numpy as np
 import pandas as pd
 # from cycler import cycler
 from datetime import datetime
 # import matplotlib.pyplot as plt
 
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 from json import JSONDecodeError
+import http_client
+import tracing
+from frames import compact
 
 startup_network = st.secrets.startup_network
 
@@ -25,7 +29,8 @@ colors = ['#687090','#DF1864','#FFCD05','#A770A0','#93278F',
 color_names = ['Grey','Pink','Yellow','Light purple','Purple',
                'Light blue','Light green','Turquoise','Typeform', ]
 
-exclude_list = [
+# A set, so membership checks stay O(1); see is_excluded for subdomains
+exclude_list = frozenset([
     '?', '??', '???', 'N/A', 'n/a', '\n',
     'none.com','N','n','None','none',
     ' ','Stealth','stealth',
@@ -42,7 +47,27 @@ exclude_list = [
     'youtube.com','squarespace.com','google.com',
     'crunchbase.com','f6s.com','facebook.com',
     'apple.com',
-]
+])
+
+# Multi-label public suffixes, under which the registrable domain has 3 labels
+public_suffixes = frozenset([
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au',
+    'com.br', 'net.br', 'org.br',
+    'com.cn', 'net.cn', 'org.cn',
+    'co.in', 'net.in', 'org.in',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp',
+    'co.ke', 'or.ke',
+    'co.kr', 'or.kr',
+    'com.mx', 'org.mx',
+    'co.nz', 'net.nz', 'org.nz',
+    'com.sg', 'org.sg',
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'ltd.uk', 'plc.uk', 'me.uk',
+    'co.za', 'org.za',
+    'us.com', 'uk.com', 'eu.com',
+])
+
+# A scheme only counts when followed by //, so host:port isn't read as scheme:host
+host_pattern = re.compile(r'^(?:[a-z][a-z0-9+.-]*://)?/*([^/?#\s]+)')
 
 # default_cycler = (cycler(color=colors))
 # plt.rc('axes', prop_cycle=default_cycler)
@@ -50,7 +75,7 @@ exclude_list = [
 # plt.rc('axes.spines', right=False)
 # plt.rc('axes.spines', top=False)
 
-def query_streak(url):
+def query_streak(path, params=None, stream=False):
     """Query Streak using Tavi's account"""
     
     headers = {
@@ -58,30 +83,27 @@ def query_streak(url):
         'authorization': f"Basic {st.secrets.streak_key}"
         }
 
-    s = requests.Session()
-    retries = Retry(total=5, backoff_factor=1, 
-                    status_forcelist=[ 429, 500, 502, 503, 504 ])
-    s.mount('https://', HTTPAdapter(max_retries=retries))
-
-    response = s.request("GET", url, headers=headers)
+    response = http_client.request('streak', "GET", path, 
+                                   params=params, headers=headers, stream=stream)
+    response.raise_for_status()
 
     return response
 
 def get_pipelines():
     """Get all pipeline names and keys"""
 
-    url = "https://www.streak.com/api/v1/pipelines"
-    r = query_streak(url)
-    pipes = pd.DataFrame(r.json())
+    path = "/v1/pipelines"
+    r = query_streak(path)
+    pipes = pd.DataFrame(http_client.decode('streak', r))
 
     return pipes
 
 def get_contact(contact_key):
     """Get contact for a given contact_key"""
 
-    url = f"https://www.streak.com/api/v2/contacts/{contact_key}"
-    r = query_streak(url)
-    contact = pd.Series(r.json())
+    path = f"/v2/contacts/{contact_key}"
+    r = query_streak(path)
+    contact = pd.Series(http_client.decode('streak', r))
     cols = ['familyName','givenName','emailAddresses','title']
 
     return contact.reindex(cols)
@@ -89,19 +111,18 @@ def get_contact(contact_key):
 def get_stages(pipeline_key=startup_network):
     """Get stages for a given pipeline_key"""
 
-    url = f"https://www.streak.com/api/v1/pipelines/{pipeline_key}/stages"
-    r = query_streak(url)
-    return r.json()
+    path = f"/v1/pipelines/{pipeline_key}/stages"
+    r = query_streak(path)
+    return http_client.decode('streak', r)
 
-def get_boxes(pipeline_key=startup_network):
-    """Get boxes for a given pipeline_key"""
-    
-    url = f"https://www.streak.com/api/v1/pipelines/{pipeline_key}/boxes"
-    r = query_streak(url)
-    boxes = pd.DataFrame(r.json())
+def prepare_boxes(raw_boxes, pipeline_key=startup_network, stages=None):
+    """Build a boxes DataFrame with stage names and parsed timestamps"""
+
+    boxes = pd.DataFrame(raw_boxes)
     boxes.rename(columns={'name':'Name'}, inplace=True)
 
-    stages = get_stages(pipeline_key)
+    if stages is None:
+        stages = get_stages(pipeline_key)
     boxes['Stage'] = boxes['stageKey'].map(lambda key: stages[key]['name'])
     
     timestamp_cols = [col for col in boxes.columns if 'Timestamp' in col]
@@ -110,12 +131,107 @@ def get_boxes(pipeline_key=startup_network):
 
     return boxes.sort_values('creationTimestamp').reset_index()
 
+def iter_boxes(pipeline_key=startup_network):
+    """Yield every raw box in a pipeline, decoded one at a time as the response streams in"""
+
+    path = f"/v1/pipelines/{pipeline_key}/boxes"
+    with query_streak(path, stream=True) as r:
+        yield from http_client.iter_json_array('streak', r)
+
+def get_boxes(pipeline_key=startup_network):
+    """Get boxes for a given pipeline_key"""
+    
+    with tracing.span('get_boxes') as s:
+        boxes = prepare_boxes(list(iter_boxes(pipeline_key)), pipeline_key)
+        s.rows = len(boxes)
+
+    return boxes
+
+def chunked(items, size):
+    """Yield lists of up to size items from any iterable"""
+
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
+
+def get_box_page(pipeline_key=startup_network, page=0, page_size=100):
+    """Get one page of raw boxes, most recently updated first
+
+    Returns the boxes and whether there are more pages after this one.
+    """
+
+    path = f"/v1/pipelines/{pipeline_key}/boxes"
+    r = query_streak(path, params={'sortBy': 'lastUpdatedTimestamp',
+                                   'limit': page_size, 'page': page})
+    data = http_client.decode('streak', r)
+
+    # Paged requests come back as {'results': [...], 'hasNextPage': ...}
+    if type(data) is dict:
+        return data.get('results', []), data.get('hasNextPage', False)
+    else:
+        return data, len(data) == page_size
+
+def has_box_count(n, pipeline_key=startup_network):
+    """Check with a single one-box request that a pipeline holds exactly n boxes"""
+
+    if n == 0:
+        boxes, _ = get_box_page(pipeline_key, 0, 1)
+        return not boxes
+
+    boxes, more = get_box_page(pipeline_key, n - 1, 1)
+    return len(boxes) == 1 and not more
+
+def sync_boxes(store, pipeline_key=startup_network, chunk_size=1000):
+    """Apply boxes changed since the last sync to a BoxStore
+
+    Only boxes updated after the lastUpdatedTimestamp watermark are
+    downloaded. Streak has no deletions feed, so the box count is checked
+    with a one-box probe, and only a mismatch falls back to a full sync,
+    which streams every box and saves the changed ones chunk by chunk.
+    Returns the set of changed keys and the set of deleted keys.
+    """
+
+    watermark = store.get_meta('watermark')
+    stored = store.timestamps()
+    full_sync = watermark is None
+
+    if not full_sync:
+        changed, deleted = [], set()
+        page = 0
+        while True:
+            boxes, more = get_box_page(pipeline_key, page)
+            fresh = [b for b in boxes if b['lastUpdatedTimestamp'] > watermark]
+            changed += fresh
+            if len(fresh) < len(boxes) or not more:
+                break
+            page += 1
+
+        added = set(b['key'] for b in changed) - set(stored)
+        full_sync = not has_box_count(len(stored) + len(added), pipeline_key)
+
+    if full_sync:
+        changed_keys, seen = set(), set()
+        for boxes in chunked(iter_boxes(pipeline_key), chunk_size):
+            changed = [b for b in boxes if stored.get(b['key']) != b['lastUpdatedTimestamp']]
+            store.save(changed)
+            changed_keys |= set(b['key'] for b in changed)
+            seen |= set(b['key'] for b in boxes)
+            watermark = max([b['lastUpdatedTimestamp'] for b in changed] + [watermark or 0])
+        store.save(deleted=set(stored) - seen, watermark=watermark)
+
+        return changed_keys, set(stored) - seen
+
+    watermark = max([b['lastUpdatedTimestamp'] for b in changed] + [watermark or 0])
+    store.save(changed, deleted, watermark=watermark)
+
+    return set(b['key'] for b in changed), deleted
+
 def get_fields(pipeline_key=startup_network):
     """Get fields for a given pipeline and return as DataFrame"""
     
-    url = f'https://www.streak.com/api/v1/pipelines/{pipeline_key}/fields'
-    r = query_streak(url)
-    fields = pd.DataFrame(r.json())
+    path = f'/v1/pipelines/{pipeline_key}/fields'
+    r = query_streak(path)
+    fields = pd.DataFrame(http_client.decode('streak', r))
     
     return fields
 
@@ -156,55 +272,233 @@ def field_iterator(box_fields, column_key, decoder=None):
     except KeyError:
         return
 
-def extract_field(boxes, fields, column_name, 
+def get_schema(pipeline_key=startup_network):
+    """Get the raw fields schema (JSON text) for a pipeline"""
+
+    path = f'/v1/pipelines/{pipeline_key}/fields'
+    r = query_streak(path)
+
+    return r.text
+
+def get_decoders(pipeline_key=startup_network):
+    """Get the compiled field decoders for a pipeline's current schema"""
+
+    return compile_decoders(get_schema(pipeline_key))
+
+@lru_cache(maxsize=8)
+def compile_decoders(schema):
+    """Compile a fields schema (raw JSON) to {name: (key, type, decoder)}
+
+    Cached on the schema text, so each schema version is compiled once.
+    """
+
+    decoders = {}
+    for field in json.loads(schema):
+        if field['type'] == 'TAG':
+            decoder = {t['key']: t['tag'] for t in field['tagSettings']['tags']}
+        elif field['type'] == 'DROPDOWN':
+            decoder = {i['key']: i['name'] for i in field['dropdownSettings']['items']}
+        else:
+            decoder = None
+        decoders[field['name']] = (field['key'], field['type'], decoder)
+
+    return decoders
+
+def decode_fields(boxes, column_names, decoders):
+    """Decode several custom fields in one pass over boxes['fields']
+
+    Returns a dict of column_name: values, aligned with boxes.
+    """
+
+    wanted = [decoders[name] for name in column_names]
+    columns = [[] for _ in wanted]
+
+    for box_fields in boxes['fields']:
+        for values, (key, _, decoder) in zip(columns, wanted):
+            values.append(field_iterator(box_fields, key, decoder))
+
+    decoded = {}
+    for name, values, (_, field_type, decoder) in zip(column_names, columns, wanted):
+        if field_type == 'DROPDOWN':
+            decoded[name] = pd.Categorical(values, decoder.values(), ordered=True)
+        else:
+            decoded[name] = pd.Series(values, index=boxes.index)
+
+    return decoded
+
+def extract_field(boxes, decoders, column_name, 
                   pipeline_key=startup_network):
-    """Return field values for given boxes, fields, and column_name"""
+    """Return field values for given boxes, decoders, and column_name"""
 
-    field, decoder = get_column_info(column_name, pipeline_key)
+    if decoders is None:
+        decoders = get_decoders(pipeline_key)
 
-    new_col = boxes['fields'].apply(field_iterator, 
-                                    column_key=field['key'],
-                                    decoder=decoder)
+    return decode_fields(boxes, [column_name], decoders)[column_name]
 
-    if field['type'] == 'DROPDOWN':
-        return pd.Categorical(new_col, decoder.values(), ordered=True)
-    else:
-        return new_col
-
-def ph_contact(row):
-    """Return the level of our relationship with a startup"""
-
-    if row['Stage'] == 'Portfolio Company':
-        return 'PHV Portfolio'
-    elif (# Meeting Notes are *about* companies, not *with* companies
-          row['callLogCount'] > 0 or
-          row['Stage'] == 'Engaged'):
-        return 'Interviewed'
-    elif (type(row['contacts']) == list or 
-          row['gmailThreadCount'] > 0):
-        return 'Email contact'
-    else:
-        return 'Database-only'
+def tag_matrix(tags, vocabulary=None):
+    """Multi-hot encode a Series of tag lists as sparse boolean columns, one per tag
 
-def get_startup_network():
-    """Get and prepare all boxes for the Startup Network"""
-    
-    sn = get_boxes()
+    Tags outside vocabulary are ignored; by default every tag seen is used.
+    """
+
+    exploded = tags.explode().dropna()
+    codes = pd.Categorical(exploded, categories=vocabulary)
+    keep = codes.codes >= 0
+
+    rows = tags.index.get_indexer(exploded.index[keep])
+    columns = codes.codes[keep]
+
+    matrix = {}
+    for i, tag in enumerate(codes.categories):
+        hot = np.zeros(len(tags), dtype=bool)
+        hot[rows[columns == i]] = True
+        matrix[tag] = pd.arrays.SparseArray(hot, fill_value=False)
+
+    return pd.DataFrame(matrix, index=tags.index)
+
+def tag_rows(matrix, tag):
+    """Return the row positions that have a tag in a tag_matrix frame"""
+
+    return matrix[tag].array.sp_index.indices
+
+def with_any_tags(matrix, tags):
+    """Flag rows of a tag_matrix frame that have at least one of tags"""
+
+    hits = np.zeros(len(matrix), dtype=bool)
+    for tag in tags:
+        hits[tag_rows(matrix, tag)] = True
+
+    return pd.Series(hits, index=matrix.index)
+
+def with_all_tags(matrix, tags):
+    """Flag rows of a tag_matrix frame that have every one of tags"""
+
+    hits = np.ones(len(matrix), dtype=bool)
+    for tag in tags:
+        has_tag = np.zeros(len(matrix), dtype=bool)
+        has_tag[tag_rows(matrix, tag)] = True
+        hits &= has_tag
+
+    return pd.Series(hits, index=matrix.index)
+
+def ph_contacts(sn):
+    """Return the level of our relationship with each startup"""
+
+    levels = np.select(
+        [sn['Stage'] == 'Portfolio Company',
+         # Meeting Notes are *about* companies, not *with* companies
+         (sn['callLogCount'] > 0) | (sn['Stage'] == 'Engaged'),
+         (sn['contacts'].map(type) == list) | (sn['gmailThreadCount'] > 0)],
+        ['PHV Portfolio', 'Interviewed', 'Email contact'],
+        'Database-only')
+
+    return pd.Series(levels, index=sn.index)
+
+def prepare_startup_network(sn, pipeline_key=startup_network, 
+                            fields=startup_fields, decoders=None):
+    """Extract custom fields and derived columns for a boxes DataFrame"""
     
-    fields = get_fields()
-    for field in startup_fields:
-        sn[field] = extract_field(sn, fields, field)
+    if decoders is None:
+        decoders = get_decoders(pipeline_key)
+    with tracing.span('field extraction') as s:
+        for field, values in decode_fields(sn, fields, decoders).items():
+            sn[field] = values
+        s.rows = len(sn)
 
     sn['Quality Check'] = pd.Categorical(sn['Quality Check'], 
                             categories=qualities, ordered=True)
 
 
-    _,tags = get_column_info('Focus')
-    focus = [sn['Focus'].str.contains(tag, regex=False).rename(tag) for tag in tags.values()]
-    focus = pd.concat(focus, axis=1)
+    tags = decoders['Focus'][2]
+    focus = tag_matrix(sn['Focus'], vocabulary=list(tags.values()))
     sn = pd.concat([sn, focus], axis=1)
 
-    sn['PH Contact'] = sn.apply(ph_contact, axis=1)
+    sn['PH Contact'] = ph_contacts(sn)
+    return sn
+
+# Raw nested box columns, dropped once the values we need are extracted
+raw_box_columns = ['fields', 'contacts']
+
+# The top-level box values the dashboard uses; the rest are dropped as boxes are read
+box_columns = ['key', 'name', 'stageKey', 'creationTimestamp', 'lastUpdatedTimestamp',
+               'callLogCount', 'gmailThreadCount', 'contacts', 'fields']
+
+def slim_box(box, field_keys):
+    """Return a box with only box_columns and the custom fields in field_keys"""
+
+    slim = {col: box.get(col) for col in box_columns}
+    values = box.get('fields') or {}
+    slim['fields'] = {k: values[k] for k in field_keys if k in values}
+    return slim
+
+def build_startup_network(raw_boxes, pipeline_key=startup_network, fields=startup_fields, 
+                          decoders=None, chunk_size=2000):
+    """Prepare an iterable of raw boxes chunk by chunk, without the raw box columns
+
+    Each chunk is slimmed to the values we need, prepared and stripped of
+    its nested columns before the next one is read, so memory grows with
+    the prepared rows rather than the raw boxes.
+    """
+
+    if decoders is None:
+        decoders = get_decoders(pipeline_key)
+    stages = get_stages(pipeline_key)
+    field_keys = set(decoders[name][0] for name in fields)
+
+    parts, offset = [], 0
+    for chunk in chunked(raw_boxes, chunk_size):
+        boxes = prepare_boxes([slim_box(b, field_keys) for b in chunk], pipeline_key, stages)
+        part = prepare_startup_network(boxes, pipeline_key, fields, decoders)
+        part['index'] += offset
+        offset += len(chunk)
+        parts.append(part.drop(columns=raw_box_columns))
+
+    if not parts:
+        return pd.DataFrame(columns=['index', 'key', 'creationTimestamp'])
+
+    sn = pd.concat(parts).sort_values('creationTimestamp', kind='stable')
+    return sn.reset_index(drop=True)
+
+def get_startup_network(store=None, pipeline_key=startup_network, 
+                        fields=startup_fields):
+    """Get and prepare all boxes for the Startup Network
+
+    With a BoxStore, only boxes changed since the last sync are fetched
+    and prepared; the rest of the frame is reused from the store. The
+    frame is compacted (see frames.compact) without the raw box columns.
+    """
+    
+    if store is None:
+        with tracing.span('get_boxes') as s:
+            sn = build_startup_network(iter_boxes(pipeline_key), pipeline_key, fields)
+            s.rows = len(sn)
+        return compact(sn)
+
+    schema = get_schema(pipeline_key)
+    decoders = compile_decoders(schema)
+    # The stored frame is only reusable if it was built the same way
+    version = hashlib.sha1((schema + repr(fields) + repr(raw_box_columns) + 
+                            repr(box_columns)).encode()).hexdigest()
+
+    with tracing.span('sync_boxes') as s:
+        changed, deleted = sync_boxes(store, pipeline_key)
+        s.rows = len(changed) + len(deleted)
+    sn = store.load_frame() if store.get_meta('frame_version') == version else None
+
+    if sn is None:
+        sn = build_startup_network(store.iter_boxes(), pipeline_key, fields, decoders)
+    elif changed or deleted:
+        sn = sn.loc[~sn['key'].isin(changed | deleted)].drop(columns='index')
+        if changed:
+            new = build_startup_network(store.iter_boxes(changed), pipeline_key, fields, decoders)
+            sn = pd.concat([sn, new.drop(columns='index')])
+        sn = sn.sort_values('creationTimestamp').reset_index(drop=True).reset_index()
+    else:
+        return sn
+
+    sn = compact(sn)
+    store.save_frame(sn)
+    store.save(frame_version=version)
     return sn
 
 def unravel(series, split_string=' '):
@@ -224,24 +518,57 @@ def count_words(series):
     
     return counts
 
+@lru_cache(maxsize=100_000)
 def find_domain(website):
     """Extract the domain from website"""
     
-    if website is None:
+    if not isinstance(website, str):
         return None
-    
-    pattern = '//(.+?)/'
-    m = re.search(pattern, website)
-    if m: subs = m.group(1).split('.')
-    else: subs = website.split('.')
 
-    if subs[-1] in ['au','br','cn','jp','ke','kr','nz','uk','za'] or '.us.com' in website:
-        domain = '.'.join(subs[-3:])
+    website = website.strip().lower()
+    m = host_pattern.match(website)
+    host = m.group(1) if m else website
+    labels = host.split(':')[0].strip('./').split('.')
+
+    if '.'.join(labels[-2:]) in public_suffixes:
+        return '.'.join(labels[-3:])
     else:
-        domain = '.'.join(subs[-2:])
-    if 'https://' in domain:
-        domain = domain.replace('https://', '')
-    if 'http://' in domain:
-        domain = domain.replace('http://', '')
+        return '.'.join(labels[-2:])
+
+def excluded_domain(domain, exclude=exclude_list):
+    """Return True if domain, or a parent domain of it, is in exclude
+
+    Parents that are public suffixes (e.g. us.com) don't count, so excluding
+    one doesn't exclude every site registered under it.
+    """
+
+    if domain in exclude:
+        return True
+    if not isinstance(domain, str):
+        return False
+
+    labels = domain.split('.')
+    for n in range(2, len(labels)):
+        parent = '.'.join(labels[-n:])
+        if parent in exclude and parent not in public_suffixes:
+            return True
+
+    return False
+
+def map_unique(func, values):
+    """Apply func to each distinct value of a Series once, then broadcast back"""
+
+    codes, uniques = pd.factorize(values)
+    results = np.array([func(u) for u in uniques] + [func(None)], dtype=object)
+
+    return pd.Series(results[codes], index=values.index)
+
+def find_domains(websites):
+    """find_domain over a whole Series, computing each distinct URL once"""
+
+    return map_unique(find_domain, websites)
+
+def is_excluded(domains, exclude=exclude_list):
+    """Flag which domains in a Series are excluded (see excluded_domain)"""
 
-    return domain.lower().strip().strip('/')
\ No newline at end of file
+    return map_unique(lambda d: excluded_domain(d, exclude), domains).astype(bool)
@@ -0,0 +1,118 @@
+from contextlib import closing
+from pathlib import Path
+import pandas as pd
+from sqlite_store import SQLiteStore
+
+default_path = Path(__file__).parent / 'data' / 'rollups.sqlite'
+
+schema = """
+CREATE TABLE IF NOT EXISTS facts (
+    identifier TEXT,
+    announced_on TEXT,
+    investment_type TEXT,
+    stage TEXT,
+    category TEXT,
+    usd REAL,
+    PRIMARY KEY (identifier, category)
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    period TEXT,
+    bucket TEXT,
+    dimension TEXT,
+    value TEXT,
+    rounds INTEGER,
+    usd REAL,
+    PRIMARY KEY (period, bucket, dimension, value)
+);
+"""
+
+# Columns of a facts frame, one row per round and category
+fact_columns = ['identifier', 'announced_on', 'investment_type', 'stage', 'category', 'usd']
+
+# Rollup dimensions and the fact column each one groups by
+dimensions = {'Stage': 'stage', 'investment_type': 'investment_type', 'category': 'category'}
+
+def normalize(facts):
+    """Return facts as plain Python values, so stored and fresh facts compare equal"""
+
+    facts = facts[fact_columns].astype({'announced_on': str, 'usd': float})
+    return facts.astype(object).where(facts.notna(), None)
+
+def contributions(facts):
+    """Return what facts add to each (period, bucket, dimension, value) rollup"""
+
+    day = pd.to_datetime(facts['announced_on'])
+    periods = {'W': day - pd.to_timedelta(day.dt.weekday, unit='D'),
+               'M': day.dt.to_period('M').dt.start_time}
+
+    parts = []
+    for period, bucket in periods.items():
+        for dimension, column in dimensions.items():
+            part = pd.DataFrame({'period': period, 'bucket': bucket.dt.strftime('%Y-%m-%d'),
+                                 'dimension': dimension, 'value': facts[column],
+                                 'identifier': facts['identifier'], 'usd': facts['usd']})
+            if column != 'category':
+                # Count a round once, not once per category
+                part = part.drop_duplicates('identifier')
+            parts.append(part)
+
+    parts = pd.concat(parts, ignore_index=True)
+    keys = ['period', 'bucket', 'dimension', 'value']
+
+    return parts.groupby(keys).agg(rounds=('identifier', 'size'), usd=('usd', 'sum')).reset_index()
+
+class RoundRollupStore(SQLiteStore):
+    """Counts and dollars raised per ISO week and month, by Stage, investment type and category
+
+    update() compares each round's current facts with the stored ones and
+    only folds the differences into the rollups, so rounds that are new,
+    changed (e.g. their startup moved Stage) or gone are the only work.
+    """
+
+    def __init__(self, path=default_path):
+        super().__init__(path, schema)
+
+    def update(self, facts):
+        """Bring the rollups in line with facts; return how many rounds changed"""
+
+        facts = normalize(facts)
+
+        with closing(self.connect()) as db, db:
+            stored = normalize(pd.read_sql_query("SELECT * FROM facts", db))
+
+            # Rows only in one side of the comparison are what changed
+            both = stored.merge(facts, how='outer', indicator=True)
+            old = both.loc[both['_merge'] == 'left_only', fact_columns]
+            new = both.loc[both['_merge'] == 'right_only', fact_columns]
+            changed = set(old['identifier']) | set(new['identifier'])
+            if not changed:
+                return 0
+
+            # Take back everything changed rounds contributed, then add their new facts
+            old = stored.loc[stored['identifier'].isin(changed)]
+            new = facts.loc[facts['identifier'].isin(changed)]
+            deltas = contributions(new)
+            if len(old):
+                taken = contributions(old)
+                taken[['rounds', 'usd']] *= -1
+                deltas = pd.concat([deltas, taken])
+
+            db.executemany("DELETE FROM facts WHERE identifier = ?", [(i,) for i in changed])
+            db.executemany("INSERT INTO facts VALUES (?, ?, ?, ?, ?, ?)",
+                           new.to_dict('split', index=False)['data'])
+            db.executemany("""INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?)
+                              ON CONFLICT (period, bucket, dimension, value) DO UPDATE SET
+                              rounds = rounds + excluded.rounds, usd = usd + excluded.usd""",
+                           deltas.to_dict('split', index=False)['data'])
+            db.execute("DELETE FROM rollups WHERE rounds = 0")
+
+        return len(changed)
+
+    def rollups(self):
+        """Return every rollup row, with bucket as a datetime"""
+
+        with closing(self.connect()) as db:
+            rollups = pd.read_sql_query("SELECT * FROM rollups ORDER BY period, bucket", db)
+
+        rollups['bucket'] = pd.to_datetime(rollups['bucket'])
+        return rollups
@@ -0,0 +1,79 @@
+import json
+from contextlib import closing
+from pathlib import Path
+from sqlite_store import SQLiteStore
+
+default_path = Path(__file__).parent / 'data' / 'rounds.sqlite'
+
+schema = """
+CREATE TABLE IF NOT EXISTS rounds (
+    identifier TEXT PRIMARY KEY,
+    permalink TEXT,
+    updated_at TEXT,
+    properties TEXT
+);
+CREATE INDEX IF NOT EXISTS rounds_permalink ON rounds (permalink);
+CREATE TABLE IF NOT EXISTS synced (
+    permalink TEXT PRIMARY KEY,
+    synced_on TEXT
+);
+"""
+
+def round_identifier(entity):
+    """Return the unique identifier for a funding round entity"""
+
+    return entity.get('uuid') or entity['properties']['identifier']['uuid']
+
+def round_permalink(entity):
+    """Return the permalink of the organization that raised a round"""
+
+    org = entity['properties'].get('funded_organization_identifier')
+    return org['permalink'] if org else None
+
+class RoundStore(SQLiteStore):
+    """On-disk store of Crunchbase funding rounds, keyed by round identifier
+
+    Each permalink remembers the date it was last synced, which is the
+    watermark for fetching only rounds updated since then.
+    """
+
+    def __init__(self, path=default_path):
+        super().__init__(path, schema)
+
+    def watermarks(self):
+        """Return {permalink: synced_on} for every permalink synced so far"""
+
+        with closing(self.connect()) as db:
+            return dict(db.execute("SELECT permalink, synced_on FROM synced"))
+
+    def save(self, entities, synced=(), synced_on=None):
+        """Upsert round entities and mark permalinks as synced on synced_on"""
+
+        rows = [(round_identifier(e), round_permalink(e),
+                 e['properties'].get('updated_at'), json.dumps(e['properties']))
+                for e in entities]
+
+        with closing(self.connect()) as db, db:
+            db.executemany("INSERT OR REPLACE INTO rounds VALUES (?, ?, ?, ?)", rows)
+            db.executemany("INSERT OR REPLACE INTO synced VALUES (?, ?)",
+                           [(p, synced_on) for p in synced])
+
+    def iter_load(self, permalinks=None, chunk_size=10_000):
+        """Yield stored round entities in chunks, optionally only for some permalinks"""
+
+        if permalinks is not None:
+            permalinks = set(permalinks)
+
+        with closing(self.connect()) as db:
+            rows = db.execute("SELECT identifier, permalink, properties FROM rounds ORDER BY rowid")
+            while True:
+                chunk = rows.fetchmany(chunk_size)
+                if not chunk:
+                    return
+                yield [{'uuid': i, 'properties': json.loads(p)} for i, link, p in chunk
+                       if permalinks is None or link in permalinks]
+
+    def load(self, permalinks=None):
+        """Return stored round entities, optionally only for some permalinks"""
+
+        return [e for chunk in self.iter_load(permalinks) for e in chunk]
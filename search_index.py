@@ -0,0 +1,157 @@
+import hashlib, re
+from collections import Counter
+from contextlib import closing
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from sqlite_store import SQLiteStore
+
+default_path = Path(__file__).parent / 'data' / 'search.sqlite'
+
+schema = """
+CREATE TABLE IF NOT EXISTS documents (
+    key TEXT PRIMARY KEY,
+    digest TEXT,
+    length INTEGER
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT,
+    key TEXT,
+    count INTEGER,
+    PRIMARY KEY (term, key)
+);
+CREATE INDEX IF NOT EXISTS postings_key ON postings (key);
+"""
+
+token_pattern = re.compile(r'[a-z0-9]+')
+
+# Words too common to say anything about a company
+stop_words = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'in',
+    'is', 'it', 'its', 'of', 'on', 'or', 'that', 'the', 'their', 'to', 'we',
+    'with', 'our', 'this', 'which', 'can', 'into', 'more', 'than',
+])
+
+def tokenize(text):
+    """Return the lowercase words of a text, without stop words"""
+
+    if not isinstance(text, str):
+        return []
+    return [t for t in token_pattern.findall(text.lower()) if t not in stop_words]
+
+def as_words(values):
+    """Join a column of strings or lists of strings into one string per row"""
+
+    values = values.astype(object)
+    return values.map(lambda v: ' '.join(v) if isinstance(v, list) else v if isinstance(v, str) else '')
+
+def documents(sn, organizations=None):
+    """Return one searchable text per Startup Network box, as a frame of key and text
+
+    The text is the box's name, Description and categories, plus its
+    Crunchbase short description and categories when its domain matched.
+    """
+
+    parts = [sn['Name'], sn['Description'], sn['Primary Category'], sn['Thesis Sector']]
+
+    if organizations is not None and len(organizations):
+        orgs = organizations.drop_duplicates('domain').set_index('domain')
+        for col in ['description', 'categories', 'category_groups']:
+            parts.append(sn['domain'].map(orgs[col].astype(object)))
+
+    text = as_words(parts[0])
+    for part in parts[1:]:
+        text = text + ' ' + as_words(part)
+
+    return pd.DataFrame({'key': sn['key'].astype(str), 'text': text.to_numpy()})
+
+class SearchIndex(SQLiteStore):
+    """Inverted index of words to the documents (Startup Network boxes) using them
+
+    update() only re-tokenizes documents whose text changed, and drops
+    those that are gone. postings() returns the index with TF-IDF weights,
+    sorted by term, for search().
+    """
+
+    def __init__(self, path=default_path):
+        super().__init__(path, schema)
+
+    def update(self, docs):
+        """Bring the index in line with docs (key, text); return how many documents changed"""
+
+        digests = [hashlib.sha1(t.encode()).hexdigest() for t in docs['text']]
+
+        with closing(self.connect()) as db, db:
+            stored = dict(db.execute("SELECT key, digest FROM documents"))
+            changed = [(key, text, digest) for key, text, digest in zip(docs['key'], docs['text'], digests)
+                       if stored.get(key) != digest]
+            gone = set(stored) - set(docs['key'])
+
+            stale = [(key,) for key, _, _ in changed] + [(key,) for key in gone]
+            db.executemany("DELETE FROM postings WHERE key = ?", stale)
+            db.executemany("DELETE FROM documents WHERE key = ?", stale)
+
+            for key, text, digest in changed:
+                counts = Counter(tokenize(text))
+                db.execute("INSERT INTO documents VALUES (?, ?, ?)",
+                           (key, digest, sum(counts.values())))
+                db.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                               [(term, key, n) for term, n in counts.items()])
+
+        return len(changed) + len(gone)
+
+    def postings(self):
+        """Return every (term, key) posting with its count and TF-IDF weight, sorted by term
+
+        term is a categorical whose categories are in the same sorted order,
+        so a term's postings are found by binary search on its code.
+        """
+
+        with closing(self.connect()) as db:
+            postings = pd.read_sql_query("SELECT term, key, count FROM postings ORDER BY term, key", db)
+            lengths = dict(db.execute("SELECT key, length FROM documents"))
+
+        # Smoothed, so a word in every document still counts for a little
+        df = postings.groupby('term', sort=False)['key'].transform('size')
+        idf = np.log((1 + len(lengths)) / (1 + df)) + 1
+        weight = postings['count'] / postings['key'].map(lengths).clip(lower=1) * idf
+
+        terms = postings['term'].unique()
+        return pd.DataFrame({'term': pd.Categorical(postings['term'], categories=terms),
+                             'key': postings['key'].astype('category'),
+                             'count': postings['count'],
+                             'weight': weight})
+
+def search(postings, query, limit=20):
+    """Rank documents for a keyword query by their summed TF-IDF weights, best first
+
+    Returns a frame of key and score; documents matching more of the
+    query's words score higher.
+    """
+
+    terms = postings['term'].cat.categories
+    codes = postings['term'].cat.codes.to_numpy()
+
+    rows = []
+    for term in set(tokenize(query)):
+        if term in terms:
+            code = terms.get_loc(term)
+            first, last = codes.searchsorted([code, code + 1])
+            rows.append(np.arange(first, last))
+    rows = np.concatenate(rows) if rows else np.array([], dtype=int)
+
+    # Sum each document's weights by its key code, then take the best
+    keys = postings['key'].cat
+    scores = np.bincount(keys.codes.to_numpy()[rows], weights=postings['weight'].to_numpy()[rows],
+                         minlength=len(keys.categories))
+    best = np.argsort(-scores, kind='stable')[:limit]
+    best = best[scores[best] > 0]
+
+    return pd.DataFrame({'key': keys.categories[best].astype(str), 'score': scores[best]})
+
+def term_counts(postings):
+    """Return how many documents use each term and how often, most used first"""
+
+    counts = postings.groupby('term', observed=True).agg(documents=('key', 'size'),
+                                                         count=('count', 'sum'))
+    return counts.sort_values(['count', 'documents'], ascending=False).reset_index()
@@ -0,0 +1,284 @@
+import json, os, shutil, threading, time, traceback
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from datetime import datetime, timedelta
+from pathlib import Path
+import pandas as pd
+import powerhouse as ph
+import crunchbase as cb
+import toggl
+import tracing
+import frames
+from box_store import BoxStore
+from toggl_store import TimeEntryStore
+from rollup_store import RoundRollupStore
+from search_index import SearchIndex
+import search_index
+
+default_path = Path(__file__).parent / 'data' / 'snapshots'
+
+# Saved snapshot versions kept on disk, newest first
+keep_versions = 3
+
+# Every dataset the page shows, built together at one point in time
+Snapshot = namedtuple('Snapshot', ['built_at', 'data'])
+
+def add_crunchbase_keys(sn):
+    """Add each box's Crunchbase permalink and website domain, missing for boxes without them"""
+
+    sn = sn.rename(columns={'permalink': 'permalink_streak'})
+    # Compacted columns hold NaN (not None) where a box has no permalink
+    sn['permalink'] = sn['permalink_streak'].astype(object).map(
+        lambda s: s.split('/')[-1] if s else None, na_action='ignore')
+    sn['domain'] = ph.find_domains(sn['Website'])
+
+    return sn
+
+def load_startup_network(built):
+    sn = ph.get_startup_network(store=BoxStore(),
+                                fields=ph.startup_fields + ['permalink'])
+
+    return add_crunchbase_keys(sn)
+
+def load_rounds(built):
+    sn = built['startup_network']
+
+    permalinks = sn['permalink'].loc[~ph.is_excluded(sn['domain'])]
+    permalinks = permalinks.dropna().drop_duplicates().tolist()
+
+    # Sorted, so any week's rounds are a slice found by binary search
+    rounds = cb.load_all_rounds(permalinks)
+    return rounds.sort_values('announced_on', ignore_index=True)
+
+def round_facts(rounds, sn):
+    """One row per round and Primary Category, with its startup's current Stage"""
+
+    startups = sn[['permalink', 'Stage', 'Primary Category']].drop_duplicates('permalink')
+    facts = rounds.merge(startups, on='permalink').dropna(subset=['announced_on'])
+    facts = facts.explode('Primary Category')
+
+    facts = pd.DataFrame({
+        'identifier': facts['uuid'],
+        'announced_on': facts['announced_on'].dt.strftime('%Y-%m-%d'),
+        'investment_type': facts['investment_type'],
+        'stage': facts['Stage'],
+        'category': facts['Primary Category'].fillna('Uncategorized'),
+        'usd': facts['usd_raised'],
+    })
+
+    return facts.drop_duplicates(['identifier', 'category'])
+
+def load_round_rollups(built):
+    with tracing.span('round rollups') as s:
+        store = RoundRollupStore()
+        store.update(round_facts(built['rounds'], built['startup_network']))
+        rollups = store.rollups()
+        s.rows = len(rollups)
+
+    return rollups
+
+def load_hours(built):
+    """Sync new time entries and return hours per project for each period (W and M)"""
+
+    with tracing.span('toggl time entries') as s:
+        store = TimeEntryStore()
+        for workspace in toggl.workspace_ids:
+            toggl.sync_time_entries(store, workspace)
+        hours = pd.concat([store.hours(period).assign(period=period) for period in ['W', 'M']],
+                          ignore_index=True)
+        s.rows = len(hours)
+
+    return hours
+
+# The Crunchbase profile columns the dashboard uses
+organization_columns = ['domain', 'name', 'permalink', 'description', 'categories', 'category_groups']
+
+def load_organizations(built):
+    """Crunchbase profiles for the Startup Network's domains, matched via the OrgCache"""
+
+    sn = built['startup_network']
+    domains = sn['domain'].loc[~ph.is_excluded(sn['domain'])].dropna().unique().tolist()
+    found = {d: e for d, e in cb.match_domains(domains).items() if e}
+    if not found:
+        return pd.DataFrame(columns=organization_columns)
+
+    orgs = cb.parse_organizations(list(found.values()))
+    orgs['domain'] = list(found)
+    return orgs[organization_columns]
+
+def load_search_index(built):
+    with tracing.span('search index') as s:
+        index = SearchIndex()
+        index.update(search_index.documents(built['startup_network'], built['organizations']))
+        postings = index.postings()
+        s.rows = len(postings)
+
+    return postings
+
+# Independent chains of loaders, built concurrently. Within a chain,
+# loaders run in order and each gets the datasets built before it.
+chains = [
+    {'projects': lambda built: toggl.get_projects(),
+     'hours': load_hours},
+    {'startup_network': load_startup_network,
+     'rounds': load_rounds,
+     'round_rollups': load_round_rollups,
+     'organizations': load_organizations,
+     'search_index': load_search_index,
+     'term_counts': lambda built: search_index.term_counts(built['search_index'])},
+]
+
+class Refresher:
+    """Rebuild all datasets in a background thread, ahead of them going stale
+
+    Readers only ever see a completed Snapshot: a refresh builds every
+    dataset first and then replaces the snapshot in one assignment. The
+    latest snapshot is also saved to disk as Arrow files, so a restarted
+    app memory-maps it and serves it straight away while a fresh one is
+    built. Until the very first snapshot exists, readers get each dataset
+    as soon as it is built.
+    """
+
+    def __init__(self, chains=chains, path=default_path,
+                 refresh_every=timedelta(hours=20), retry_every=timedelta(minutes=10)):
+        self.chains = chains
+        self.path = Path(path)
+        self.refresh_every = refresh_every
+        self.retry_every = retry_every
+        self.snapshot = None
+        self.first = {}
+        self.started = None
+        self.error = None
+        self.changed = threading.Condition()
+        self.thread = None
+
+        self.snapshot = self.load()
+
+    def build(self, chain, built):
+        for name, loader in chain.items():
+            data = loader(built)
+            with self.changed:
+                built[name] = data
+                if self.snapshot is None:
+                    self.first = built
+                self.changed.notify_all()
+
+    def refresh(self):
+        """Build every dataset and swap in the new snapshot"""
+
+        self.started = datetime.now()
+        built = {}
+        with ThreadPoolExecutor(max_workers=len(self.chains)) as pool:
+            futures = [pool.submit(tracing.bind(self.build), chain, built) for chain in self.chains]
+            for future in futures:
+                future.result()
+
+        snapshot = Snapshot(self.started, built)
+        self.save(snapshot)
+        with self.changed:
+            self.snapshot = snapshot
+            self.error = None
+            self.changed.notify_all()
+
+    def save(self, snapshot):
+        """Write a snapshot to a new version directory, then point LATEST at it
+
+        Each dataset is an Arrow IPC file; meta.json records when the
+        snapshot was built and each dataset's rows and column dtypes.
+        """
+
+        version = snapshot.built_at.strftime('%Y%m%dT%H%M%S%f')
+        folder = self.path / version
+        folder.mkdir(parents=True, exist_ok=True)
+
+        meta = {'built_at': snapshot.built_at.isoformat(), 'datasets': {}}
+        for name, frame in snapshot.data.items():
+            frames.write_frame(frame, folder / f'{name}.arrow')
+            meta['datasets'][name] = {'rows': len(frame), 
+                                      'dtypes': frame.dtypes.astype(str).to_dict()}
+        (folder / 'meta.json').write_text(json.dumps(meta, indent=1))
+
+        # Rename over the old pointer, so it never names a half-written version
+        partial = self.path / 'LATEST.partial'
+        partial.write_text(version)
+        os.replace(partial, self.path / 'LATEST')
+
+        versions = sorted(p for p in self.path.iterdir() if p.is_dir())
+        for old in versions[:-keep_versions]:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def load(self):
+        """Return the latest saved Snapshot, or None if there's no usable one"""
+
+        latest = self.path / 'LATEST'
+        if not latest.exists():
+            return None
+
+        try:
+            folder = self.path / latest.read_text().strip()
+            meta = json.loads((folder / 'meta.json').read_text())
+            names = [name for chain in self.chains for name in chain]
+            if not set(names) <= set(meta['datasets']):
+                # Saved before a dataset was added; build a complete one
+                return None
+            data = {name: frames.read_frame(folder / f'{name}.arrow') for name in names}
+        except Exception:
+            traceback.print_exc()
+            return None
+
+        return Snapshot(datetime.fromisoformat(meta['built_at']), data)
+
+    def due(self):
+        """Return how long to wait before the next refresh"""
+
+        if self.snapshot is None:
+            return timedelta(0)
+        return self.snapshot.built_at + self.refresh_every - datetime.now()
+
+    def run(self):
+        while True:
+            wait = self.due()
+            if wait > timedelta(0):
+                time.sleep(min(wait, self.retry_every).total_seconds())
+                continue
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the last snapshot and try again later
+                with self.changed:
+                    self.error = traceback.format_exc()
+                    self.changed.notify_all()
+                print(self.error)
+                time.sleep(self.retry_every.total_seconds())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='refresher', daemon=True)
+        self.thread.start()
+        return self
+
+    def get(self, *names):
+        """Return (built_at, datasets) for the named datasets
+
+        They come from the latest completed snapshot; before the first one
+        exists, this waits only until the named datasets have been built.
+        """
+
+        with self.changed:
+            self.changed.wait_for(lambda: self.snapshot or self.error or 
+                                  all(name in self.first for name in names))
+            if self.snapshot:
+                return self.snapshot.built_at, [self.snapshot.data[name] for name in names]
+            if all(name in self.first for name in names):
+                return self.started, [self.first[name] for name in names]
+
+        raise RuntimeError(f'The first refresh failed:\n{self.error}')
+
+    def latest(self):
+        """Return the latest completed snapshot, waiting for the first one if need be"""
+
+        with self.changed:
+            self.changed.wait_for(lambda: self.snapshot or self.error)
+            if self.snapshot:
+                return self.snapshot
+
+        raise RuntimeError(f'The first refresh failed:\n{self.error}')
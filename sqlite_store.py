@@ -0,0 +1,31 @@
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+class SQLiteStore:
+    """Base of the on-disk stores: one SQLite file, created with its schema on first use
+
+    Each method opens its own connection with connect(), so a store can be
+    shared between threads.
+    """
+
+    def __init__(self, path, schema):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self.connect()) as db, db:
+            db.executescript(schema)
+
+    def connect(self):
+        return sqlite3.connect(self.path)
+
+def select_in(db, sql, values, chunk_size=500):
+    """Yield the rows of sql for values, whose `{marks}` stands for the IN (...) list
+
+    The values are sent chunk_size at a time, since SQLite caps how many
+    parameters one statement can take.
+    """
+
+    values = list(values)
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:i+chunk_size]
+        yield from db.execute(sql.format(marks=','.join('?' * len(chunk))), chunk)
@@ -1,12 +1,16 @@
 import streamlit as st
 import pandas as pd
-import requests
-from datetime import datetime, timedelta, date
+from datetime import timedelta, date
 import time
 from pathlib import Path
 import powerhouse as ph
 import crunchbase as cb
 import toggl_plot
+import toggl
+import tracing
+import snapshots
+import rollup_store
+import search_index
 
 # Set the title and favicon that appear in the Browser's tab bar.
 st.set_page_config(
@@ -18,78 +22,137 @@ st.set_page_config(
 # -----------------------------------------------------------------------------
 # Declare some useful functions.
 
-@st.cache_data(ttl='1d', show_spinner='Getting Toggl data...')
-def get_toggl_data():
-    """Get project data from Toggl.
-
-    This uses caching to avoid having to read the file every time.
-    """
-
-    # later: st.secrets.key
-    headers = {'content-type': 'application/json', 
-               'Authorization': 'Basic %s' %  st.secrets.toggl_key}
-
-    # Get clients
-    data = requests.get(
-        'https://api.track.toggl.com/api/v9/workspaces/4691435/clients', 
-        headers=headers
-    )
-
-    clients = pd.DataFrame(data.json())
+@st.cache_resource
+def get_refresher():
+    """Start the one background refresher shared by every session"""
+
+    return snapshots.Refresher().start()
+
+# Started before anything renders, so every load is already under way
+refresher = get_refresher()
+
+@st.fragment
+def toggl_section():
+    """Toggl charts, drawn as soon as the Toggl data is ready"""
+
+    with st.spinner('Getting Toggl data...'):
+        built_at, (projects, hours) = refresher.get('projects', 'hours')
+
+    st.caption(f"Data as of {built_at:%Y-%m-%d %H:%M}")
+
+    toggl_analysis = toggl_plot.plot_projects(projects)
+    fig, all_time_rate = toggl_analysis[0]
+    actives_fig, recent_rate = toggl_analysis[1]
+
+    # Display all
+    data_container = st.container()
+    config = {'displayModeBar': False}
+
+    with data_container:
+        all_time, actives = st.columns(2)
+        with all_time:
+            '### All time history of Toggl projects'
+            st.metric(
+                label=f'All-time Hourly Rate',
+                value=f'${all_time_rate:,.0f}/hr',
+            )
+            st.plotly_chart(fig, use_container_width=True, config=config)
+
+        with actives:
+            '### Active or <7 day old projects only'
+            st.metric(
+                label=f'Active Hourly Rate',
+                value=f'${recent_rate:,.0f}/hr',
+            )
+            st.plotly_chart(actives_fig, use_container_width=True, config=config)
+
+    with st.expander('Effective $/hr over time'):
+        period = st.radio('Period', ['M', 'W'], horizontal=True,
+                          format_func={'M': 'Monthly', 'W': 'Weekly'}.get)
+        history = toggl.rate_history(projects, hours.loc[hours['period'] == period], period, 
+                                     by='name_client')
+        st.line_chart(history, x='bucket', y='Effective $/hr', color='name_client')
+
+    st.button("Rerun", key='rerun_toggl')
+
+@st.fragment
+def rounds_section():
+    """A week's rounds, drawn as soon as the Startup Network and rounds are ready"""
+
+    with st.spinner('Getting the Startup Network and funding rounds...'):
+        built_at, (sn, rounds, rollups) = refresher.get('startup_network', 'rounds', 'round_rollups')
+
+    st.caption(f"Data as of {built_at:%Y-%m-%d %H:%M}")
+
+    # ISO weeks, from Monday; the default is last week
+    t = date.today()
+    this_week = pd.Timestamp(t - timedelta(days=t.weekday()))
+    weeks = [this_week - pd.Timedelta(weeks=n) for n in range(52, 0, -1)]
+    week = st.select_slider('Week starting', weeks, value=weeks[-1], 
+                            format_func=lambda w: f'{w:%Y-%m-%d}')
+    weekly = rollups.loc[rollups['period'] == 'W']
+
+    with st.expander('Trailing 52 weeks'):
+        dimension = st.radio('Break down by', list(rollup_store.dimensions), horizontal=True)
+        trailing = weekly.loc[(weekly['dimension'] == dimension) & 
+                              weekly['bucket'].between(weeks[0], weeks[-1])]
+        st.bar_chart(trailing, x='bucket', y='usd', color='value', 
+                     x_label='Week', y_label='USD raised')
+
+    # Rounds are sorted by announced_on, so a week is a slice
+    first, last = rounds['announced_on'].searchsorted([week, week + pd.Timedelta(days=7)])
+    cols = ['permalink','Website','Stage']
+    recent_rounds = pd.merge(rounds.iloc[first:last], sn[cols].drop_duplicates(subset=['permalink']))
+    recent_rounds = recent_rounds.loc[~recent_rounds['Stage'].isin(['Out of Scope'])]
+
+    # Focus tags are stored as sparse multi-hot columns on the Startup Network
+    focus = sn.select_dtypes(pd.SparseDtype(bool, False))
+    focus_filter = st.multiselect('Focus', focus.columns, placeholder='All focus areas')
+    if focus_filter:
+        focused = sn.loc[ph.with_any_tags(focus, focus_filter), 'permalink']
+        recent_rounds = recent_rounds.loc[recent_rounds['permalink'].isin(focused)]
+        total_money = recent_rounds['usd_raised'].sum() / 1E6
+        total_rounds = len(recent_rounds)
+    else:
+        in_week = weekly.loc[(weekly['bucket'] == week) & (weekly['dimension'] == 'Stage') &
+                             (weekly['value'] != 'Out of Scope')]
+        total_money = in_week['usd'].sum() / 1E6
+        total_rounds = in_week['rounds'].sum()
 
-    # Get projects
-    data = requests.get(
-        'https://api.track.toggl.com/api/v9/workspaces/4691435/projects', 
-        headers=headers
-    )
+    when = 'last week' if week == weeks[-1] else f'the week of {week:%b %-d, %Y}'
+    summary_string = f"\\${total_money:.0f}M raised in {total_rounds} rounds {when}"
+    rounds_text = cb.rounds_to_text(recent_rounds.sort_values('usd_raised'))
 
-    projects = pd.DataFrame(data.json())
+    st.write(summary_string+'\n'+'\n'.join(rounds_text))
 
-    projects = pd.merge(
-        projects, clients[['name','id']], 
-        left_on='client_id', right_on='id',
-        suffixes=['','_client']
-    )
+    ''
+    ''
 
-    return projects
+    # For debugging:
+    cols = ['name','announced_on','created_at',
+            'investment_type','num_investors','investor_names',
+            'usd_raised','Stage']
+    st.dataframe(recent_rounds[cols].sort_values('announced_on').reset_index())
 
-projects = get_toggl_data()
+    st.button("Rerun", key='rerun_rounds')
 
-@st.cache_data(ttl='1d', show_spinner='Getting Startup Network...')
-def get_startup_network():
-    sn = ph.get_startup_network()
+@st.fragment
+def search_section():
+    """Keyword search over the Startup Network, ranked by TF-IDF"""
 
-    fields = ph.get_fields().set_index('name')
-    sn['permalink_streak'] = ph.extract_field(sn, fields, 'permalink')
-    sn['permalink'] = sn['permalink_streak'].map(lambda s: s.split('/')[-1] if s else None)
-    sn['domain'] = sn['Website'].map(ph.find_domain)
+    with st.spinner('Indexing the Startup Network...'):
+        built_at, (sn, postings, terms) = refresher.get('startup_network', 'search_index', 'term_counts')
 
-    st.toast("Streak load complete!", icon='✅')
-    return sn
+    query = st.text_input('Search descriptions and categories', placeholder='e.g. battery recycling')
+    if query:
+        hits = search_index.search(postings, query)
+        cols = ['key', 'Name', 'Website', 'Stage', 'Description']
+        hits = hits.merge(sn[cols].astype({'key': str}), on='key').drop(columns='key')
+        st.caption(f"{len(hits)} best matches")
+        st.dataframe(hits, hide_index=True)
 
-def simple_text_money(f):
-    """Convert a large dollar amount to $M or $k"""
-    
-    if f >= 1E6:
-        r = f"\${f/1E6:.1f}M"
-    elif f > 0:
-        r = f"\${f/1E3:.0f}k"
-    else:
-        r = 'an undisclosed amount'
-        
-    return r
-
-def round_to_text(row):
-    """Convert raise info to a descriptive string"""
-    n = f"[{row['name']}]({row['Website']})"
-    r = f"[{simple_text_money(row['usd_raised'])}]({row['url']})"
-    
-    if type(row['investor_names'])==list:
-        i = ', '.join(row['investor_names'])
-        return f"* {n} raised {r} from {i}"
-        
-    else:
-        return f"* {n} raised {r}"
+    with st.expander('Most used words'):
+        st.dataframe(terms.head(100), hide_index=True)
 
 # -----------------------------------------------------------------------------
 # Draw the actual page
@@ -99,69 +162,26 @@ def round_to_text(row):
 # :clock2: Toggl dashboard
 '''
 
-toggl_analysis = toggl_plot.plot_projects(projects)
-fig, all_time_rate = toggl_analysis[0]
-actives_fig, recent_rate = toggl_analysis[1]
-
-# Display all
-data_container = st.container()
-config = {'displayModeBar': False}
-
-with data_container:
-    all_time, actives = st.columns(2)
-    with all_time:
-        '### All time history of Toggl projects'
-        st.metric(
-            label=f'All-time Hourly Rate',
-            value=f'${all_time_rate:,.0f}/hr',
-        )
-        st.plotly_chart(fig, use_container_width=True, config=config)
-
-    with actives:
-        '### Active or <7 day old projects only'
-        st.metric(
-            label=f'Active Hourly Rate',
-            value=f'${recent_rate:,.0f}/hr',
-        )
-        st.plotly_chart(actives_fig, use_container_width=True, config=config)
+toggl_section()
 
 ''
 ''
 '''
-# :moneybag: Rounds last week
+# :moneybag: Rounds by week
 '''
 
-sn = get_startup_network()
-
-permalinks = sn['permalink'].loc[~sn['domain'].isin(ph.exclude_list)]
-permalinks = permalinks.dropna().drop_duplicates().tolist()
-rounds = cb.get_all_rounds(permalinks)
-st.toast("Funding rounds complete!", icon='💰')
-
-cols = ['permalink','Website','Stage']
-rounds = pd.merge(rounds, sn[cols].drop_duplicates(subset=['permalink']))
-
-t = date.today()
-today = datetime(t.year, t.month, t.day)
-start = today - timedelta(days=7 + t.isoweekday())
-end = start + timedelta(days=7)
-recent_rounds = rounds.loc[rounds['announced_on'].between(start, end) & 
-                          ~rounds['Stage'].isin(['Out of Scope'])]
-
-total_money = recent_rounds['usd_raised'].sum() / 1E6
-total_rounds = len(recent_rounds)
-summary_string = f"\\${total_money:.0f}M raised in {total_rounds} rounds last week"
-rounds_text = recent_rounds.sort_values('usd_raised').apply(round_to_text, axis=1)
-
-st.write(summary_string+'\n'+'\n'.join(rounds_text))
+rounds_section()
 
 ''
 ''
+'''
+# :mag: Search the Startup Network
+'''
 
-# For debugging:
-cols = ['name','announced_on','created_at',
-        'investment_type','num_investors','investor_names',
-        'usd_raised','Stage']
-st.dataframe(recent_rounds[cols].sort_values('announced_on').reset_index())
+search_section()
 
-st.button("Rerun")
\ No newline at end of file
+with st.expander('Diagnostics'):
+    'Stages run since the app started, newest last. Cached stages only appear when they reran.'
+    st.dataframe(tracing.to_frame(), hide_index=True)
+    st.download_button('Download as JSON lines', tracing.to_jsonl(), 
+                       file_name='traces.jsonl', mime='application/jsonl')
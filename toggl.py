@@ -0,0 +1,172 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+import threading
+import streamlit as st
+import pandas as pd
+import http_client
+import tracing
+
+# Workspaces to read, from the toggl_workspaces secret if set
+workspace_ids = list(st.secrets.get('toggl_workspaces', [4691435]))
+workspace_id = workspace_ids[0]
+
+# Largest page the workspace endpoints return, and pages fetched at once
+per_page = 200
+pages_ahead = 4
+
+# Clients change much less often than projects, so they're kept for longer
+client_ttl = timedelta(days=7)
+client_cache = {}
+client_lock = threading.Lock()
+
+# Resources are fetched on one pool and their pages on another, so a
+# resource waiting on its pages can never starve them of workers
+resource_executor = ThreadPoolExecutor(max_workers=8)
+page_executor = ThreadPoolExecutor(max_workers=http_client.pool_maxsize)
+
+# Oldest day to ingest time entries from on a first sync
+first_day = date(2020, 1, 1)
+
+# The Reports API searches at most about a year of entries per query
+window = timedelta(days=365)
+
+def toggl_headers():
+    return {'content-type': 'application/json',
+            'Authorization': 'Basic %s' % st.secrets.toggl_key}
+
+def get_resource(path, params=None):
+    r = http_client.request('toggl', 'GET', path, headers=toggl_headers(), params=params)
+    r.raise_for_status()
+    return http_client.decode('toggl', r) or []
+
+def get_page(path, page):
+    return get_resource(path, {'page': page, 'per_page': per_page})
+
+def get_all_pages(path):
+    """Return every item of a paged workspace resource
+
+    Pages are requested pages_ahead at a time, so a resource that fits in
+    that many pages costs a single round trip. A short or empty page ends
+    the resource, and so does a page repeating the one before it, which
+    is what an endpoint that ignores paging sends.
+    """
+
+    items, first, last = [], 1, None
+    while True:
+        pages = list(page_executor.map(tracing.bind(lambda n: get_page(path, n)),
+                                  range(first, first + pages_ahead)))
+        for page in pages:
+            if not page or page == last:
+                return items
+            items += page
+            if len(page) < per_page:
+                return items
+            last = page
+        first += pages_ahead
+
+def get_clients(workspace):
+    """Return a workspace's clients, fetching them at most every client_ttl"""
+
+    with client_lock:
+        cached = client_cache.get(workspace)
+    if cached and datetime.now() - cached[0] < client_ttl:
+        return cached[1]
+
+    # The clients endpoint isn't paged: one request returns them all
+    clients = get_resource(f'/workspaces/{workspace}/clients')
+    with client_lock:
+        client_cache[workspace] = (datetime.now(), clients)
+
+    return clients
+
+def get_projects(workspaces=None):
+    """Return projects across workspaces, with their client's name as name_client
+
+    Projects and clients for all workspaces are fetched concurrently.
+    Projects without a client are kept, with a missing name_client.
+    """
+
+    workspaces = workspaces or workspace_ids
+
+    with tracing.span('toggl fetch') as s:
+        projects = [resource_executor.submit(tracing.bind(get_all_pages), f'/workspaces/{w}/projects') 
+                    for w in workspaces]
+        clients = [resource_executor.submit(tracing.bind(get_clients), w) for w in workspaces]
+
+        projects = pd.DataFrame([p for f in projects for p in f.result()])
+        clients = pd.DataFrame([c for f in clients for c in f.result()], columns=['id', 'name'])
+
+        projects = pd.merge(
+            projects, clients.rename(columns={'id': 'id_client', 'name': 'name_client'}), 
+            how='left', left_on='client_id', right_on='id_client'
+        )
+        s.rows = len(projects)
+
+    return projects
+
+def iter_time_entries(start_date, end_date, workspace=workspace_id, page_size=1000):
+    """Yield pages of time entries started between two dates, oldest first"""
+
+    query = {'start_date': start_date.isoformat(), 'end_date': end_date.isoformat(),
+             'page_size': page_size, 'order_by': 'date', 'order_dir': 'ASC'}
+    path = f'/workspace/{workspace}/search/time_entries'
+
+    while True:
+        r = http_client.request('toggl_reports', 'POST', path,
+                                json=query, headers=toggl_headers())
+        r.raise_for_status()
+
+        # Rows group entries that share a project, user and description
+        yield [dict(entry, project_id=row.get('project_id'))
+               for row in http_client.decode('toggl_reports', r) for entry in row['time_entries']]
+
+        next_id = r.headers.get('X-Next-ID')
+        if not next_id:
+            return
+
+        query = dict(query, first_id=int(next_id),
+                     first_row_number=int(r.headers['X-Next-Row-Number']))
+
+def sync_time_entries(store, workspace=workspace_id, today=None):
+    """Ingest time entries started since the last one in the store
+
+    Pages are saved as they arrive, so an interrupted sync resumes from the
+    last entry it saved. The day of that entry is read again, since entries
+    on it may have been edited or added since.
+    """
+
+    today = today or date.today()
+    last_start = store.last_start(workspace)
+    start = date.fromisoformat(last_start[:10]) if last_start else first_day
+
+    while start <= today:
+        end = min(start + window, today + timedelta(days=1))
+        for entries in iter_time_entries(start, end, workspace):
+            store.add(entries, workspace)
+        start = end + timedelta(days=1)
+
+def rate_history(projects, hours, period='W', by='name'):
+    """Effective $/hr per period, grouped by project 'name' or 'name_client'
+
+    Each project's fixed fee accrues evenly from its start to its end date;
+    the rate for a period is the fee accrued in it over the hours logged in it.
+    """
+
+    length = pd.offsets.Week(1) if period == 'W' else pd.offsets.MonthBegin(1)
+
+    projects = projects[['id', by, 'fixed_fee', 'start_date', 'end_date']].copy()
+    projects['start_date'] = pd.to_datetime(projects['start_date'], errors='coerce').dt.tz_localize(None)
+    projects['end_date'] = pd.to_datetime(projects['end_date'], errors='coerce').dt.tz_localize(None)
+
+    history = hours.merge(projects, left_on='project_id', right_on='id')
+    period_end = history['bucket'] + length
+
+    overlap = (period_end.where(period_end < history['end_date'], history['end_date']) -
+               history['bucket'].where(history['bucket'] > history['start_date'], history['start_date']))
+    duration = history['end_date'] - history['start_date']
+    history['fee'] = history['fixed_fee'] * (overlap.dt.days.clip(lower=0) / duration.dt.days)
+
+    history = history.groupby(['bucket', by])[['fee', 'hours']].sum()
+    history['Effective $/hr'] = history['fee'] / history['hours']
+
+    return history.reset_index()
@@ -1,6 +1,10 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from collections import OrderedDict
+import hashlib, json, threading
 import plotly.graph_objects as go
+import numpy as np
 import pandas as pd
+import tracing
 
 colors = ['#687090',
  '#DF1864',
@@ -14,22 +18,41 @@ colors = ['#687090',
 
 num_colors = len(colors)
 
-def hovertext(row):
-    f = f'Fee to date: ${row["fee_to_date"]:,.0f}'
-    h = f'Hours: {row["Hours"]:.0f}'
-    r = f'Effective rate: ${row["Effective $/hr"]:.0f}/hr'
-    e = f'End date: {row["end_date"]}'
+def with_commas(numbers):
+    """Insert thousands separators into formatted numbers, like '{:,}'"""
+
+    return numbers.str.replace(r'\B(?=(\d{3})+(?!\d))', ',', regex=True)
+
+def hovertexts(projects):
+    fee = np.char.mod('%.0f', projects['fee_to_date'].to_numpy(dtype=float))
+    f = 'Fee to date: $' + with_commas(pd.Series(fee, index=projects.index))
+    h = 'Hours: ' + np.char.mod('%.0f', projects['Hours'].to_numpy(dtype=float))
+    r = 'Effective rate: $' + np.char.mod('%.0f', projects['Effective $/hr'].to_numpy(dtype=float)) + '/hr'
+    e = 'End date: ' + projects['end_date'].dt.strftime('%Y-%m-%d %H:%M:%S').fillna('NaT')
     
-    return '<br>'.join([f,h,r,e])
+    return f + '<br>' + h + '<br>' + r + '<br>' + e
+
+# Columns of the Toggl projects frame that the charts depend on
+project_columns = ['name', 'start_date', 'end_date', 'fixed_fee', 'actual_hours']
+
+def content_hash(projects):
+    """Hash the project columns the charts depend on"""
+
+    hashed = pd.util.hash_pandas_object(projects[project_columns], index=False)
+    return hashlib.sha1(hashed.to_numpy().tobytes()).hexdigest()
 
-def plot_projects(projects):
+def project_metrics(projects, today):
+    """Derive effective rates and labels as of today, leaving projects untouched"""
+
+    projects = projects[project_columns].copy()
+    now = datetime(today.year, today.month, today.day)
 
     # Calculations and formatting
     projects['start_date'] = pd.to_datetime(projects['start_date'], errors='coerce')
     projects['end_date'] = pd.to_datetime(projects['end_date'], errors='coerce')
 
     projects['duration_days'] = (projects['end_date'] - projects['start_date']).dt.days
-    projects['fraction_complete'] = (datetime.now() - projects['start_date']).dt.days / projects['duration_days']
+    projects['fraction_complete'] = (now - projects['start_date']).dt.days / projects['duration_days']
     projects.loc[projects['fraction_complete'] > 1,'fraction_complete'] = 1
 
     projects['fee_to_date'] = projects['fixed_fee'] * projects['fraction_complete']
@@ -40,18 +63,20 @@ def plot_projects(projects):
     projects['Value (USD)'] = projects['fixed_fee']
     projects['Value (k$)'] = projects['Value (USD)'].dropna().map(lambda n: f'${int(n/1000)}k')
     projects['Label'] = projects['name'].str[:] + ', ' + projects['Value (k$)'].str[:]
-    projects['Offset'] = 5
 
     projects = projects.dropna(subset=['hourly_rate'])
     projects = projects.sort_values('Effective $/hr')
+    projects['hover_text'] = hovertexts(projects)
 
-    projects = projects.dropna(subset=['hourly_rate'])
+    return projects
+
+def rate_figure(projects):
+    """Bar chart of effective $/hr per project, each bar as tall as its hours"""
+
+    projects = projects.copy()
     projects['Left'] = projects['actual_hours'].cumsum() - projects['actual_hours']
-    projects['hover_text'] = projects.apply(hovertext, axis=1)
     projects['color'] = [colors[i % num_colors] for i in range(len(projects))]
 
-    # Toggl charts
-
     fig = go.Figure()
 
     # Create horizontal bar chart
@@ -86,49 +111,48 @@ def plot_projects(projects):
     fig.update_xaxes(showline=True, linewidth=1, linecolor='black', gridcolor='rgba(0,0,0,0)')
     fig.update_yaxes(showline=True, linewidth=1, linecolor='black', gridcolor='rgba(0,0,0,0)')
 
+    return fig
+
+def build_figures(projects, today):
+    """Build the all-time and recent figures (as JSON) and their hourly rates"""
+
+    projects = project_metrics(projects, today)
+    now = datetime(today.year, today.month, today.day)
+
     # All-time hourly rate
     all_time_rate = projects['fee_to_date'].sum() / projects['actual_hours'].sum()
 
     # Recent projects
-    recents = projects.loc[datetime.now() - projects['end_date'] < timedelta(days=7)].copy()
-    recents['Left'] = recents['actual_hours'].cumsum() - recents['actual_hours']
-    recents['color'] = [colors[i % num_colors] for i in range(len(recents))]
+    recents = projects.loc[now - projects['end_date'] < timedelta(days=7)]
+    recent_rate = recents['fee_to_date'].sum() / recents['actual_hours'].sum()
 
-    # Create horizontal bar chart
-    actives_fig = go.Figure()
+    return ((rate_figure(projects).to_json(), all_time_rate), 
+            (rate_figure(recents).to_json(), recent_rate))
 
-    actives_fig.add_trace(go.Bar(
-        y=recents['Left'] + recents['Hours'] / 2,
-        x=recents['Effective $/hr'],
-        orientation='h',
-        width=recents['Hours'],
-        marker=dict(color=recents['color']),
-        name='Effective $/hr',
-        text=recents['Label'],
-        textposition='outside',
-        hovertemplate=recents['hover_text'] + '<extra></extra>',  # Custom hover text without extra info
-        hovertext='hover_text'
-    ))
+# Figures built so far, keyed on (content_hash, day); most recent last.
+# Sessions run on their own threads, so every use of it holds figure_lock.
+figure_cache = OrderedDict()
+figure_cache_size = 8
+figure_lock = threading.Lock()
 
-    # Update layout
-    actives_fig.update_layout(
-        font_color='black',
-        margin=dict(l=20, r=20, t=20, b=20),
-        height=600,  # Set the height of the figure to be taller
-        width=800,   # Set the width of the figure to be narrower
-        yaxis_title='Hours',
-        xaxis_title='Effective $/hr',
-        xaxis=dict(range=[0, recents['Effective $/hr'].max()*1.5]),
-        showlegend=False,
-        plot_bgcolor='white',  # Set the plot background color to white
-        paper_bgcolor='white'  # Set the paper background color to white
-    )
+def plot_projects(projects, today=None):
+    """Return (figure, hourly rate) for all projects and for recent ones
 
-    # Remove top and right spines (equivalent in Plotly is removing gridlines)
-    actives_fig.update_xaxes(showline=True, linewidth=1, linecolor='black', gridcolor='rgba(0,0,0,0)')
-    actives_fig.update_yaxes(showline=True, linewidth=1, linecolor='black', gridcolor='rgba(0,0,0,0)')
+    Figures are plotly figure dicts, ready for st.plotly_chart. They are
+    rebuilt only when the projects' content or the day changes.
+    """
 
-    # Average hourly rate
-    recent_rate = recents['fee_to_date'].sum() / recents['actual_hours'].sum()
+    today = today or date.today()
+    key = (content_hash(projects), today)
+
+    with tracing.span('plot_projects') as s, figure_lock:
+        if key in figure_cache:
+            figure_cache.move_to_end(key)
+        else:
+            figure_cache[key] = build_figures(projects, today)
+            if len(figure_cache) > figure_cache_size:
+                figure_cache.popitem(last=False)
+        (fig, all_time_rate), (actives_fig, recent_rate) = figure_cache[key]
+        s.rows = len(projects)
 
-    return (fig, all_time_rate), (actives_fig, recent_rate)
\ No newline at end of file
+    return (json.loads(fig), all_time_rate), (json.loads(actives_fig), recent_rate)
@@ -0,0 +1,99 @@
+from contextlib import closing
+from datetime import date, timedelta
+from pathlib import Path
+import pandas as pd
+from sqlite_store import SQLiteStore, select_in
+
+default_path = Path(__file__).parent / 'data' / 'time_entries.sqlite'
+
+schema = """
+CREATE TABLE IF NOT EXISTS time_entries (
+    id INTEGER PRIMARY KEY,
+    workspace_id INTEGER,
+    project_id INTEGER,
+    start TEXT,
+    seconds INTEGER
+);
+CREATE INDEX IF NOT EXISTS time_entries_workspace ON time_entries (workspace_id, start);
+CREATE TABLE IF NOT EXISTS hours (
+    period TEXT,
+    bucket TEXT,
+    project_id INTEGER,
+    seconds INTEGER,
+    PRIMARY KEY (period, bucket, project_id)
+);
+-- Hours without a project once went in as NULL, which never conflicts
+INSERT INTO hours SELECT period, bucket, 0, sum(seconds) FROM hours
+    WHERE project_id IS NULL GROUP BY period, bucket
+    ON CONFLICT (period, bucket, project_id) DO UPDATE SET seconds = seconds + excluded.seconds;
+DELETE FROM hours WHERE project_id IS NULL;
+"""
+
+# project_id of the hours not booked to any project; NULL would never conflict
+no_project = 0
+
+def buckets(start):
+    """Return the (period, bucket) pairs an entry starting at `start` counts toward"""
+
+    day = date.fromisoformat(start[:10])
+    week = day - timedelta(days=day.weekday())
+
+    return [('W', week.isoformat()), ('M', day.replace(day=1).isoformat())]
+
+class TimeEntryStore(SQLiteStore):
+    """On-disk store of Toggl time entries with rolling weekly and monthly hours
+
+    The hours per project and period are updated as entries are added or
+    changed, so they never need recomputing from all entries.
+    """
+
+    def __init__(self, path=default_path):
+        super().__init__(path, schema)
+
+    def last_start(self, workspace):
+        """Return the start time of the latest entry seen in a workspace, or None"""
+
+        with closing(self.connect()) as db:
+            return db.execute("SELECT max(start) FROM time_entries WHERE workspace_id = ?",
+                              (workspace,)).fetchone()[0]
+
+    def add(self, entries, workspace):
+        """Upsert finished time entries and fold their hours into the rollups"""
+
+        entries = [e for e in entries if e.get('stop') and e['seconds'] >= 0]
+        if not entries:
+            return
+
+        with closing(self.connect()) as db, db:
+            old = list(select_in(db, "SELECT project_id, start, seconds FROM time_entries "
+                                     "WHERE id IN ({marks})", [e['id'] for e in entries]))
+
+            # Take back what changed entries contributed before, then add them again
+            deltas = {}
+            for sign, rows in [(-1, old), (1, [(e['project_id'], e['start'], e['seconds']) 
+                                               for e in entries])]:
+                for project_id, start, seconds in rows:
+                    for period, bucket in buckets(start):
+                        key = (period, bucket, project_id or no_project)
+                        deltas[key] = deltas.get(key, 0) + sign * seconds
+
+            db.executemany("INSERT OR REPLACE INTO time_entries VALUES (?, ?, ?, ?, ?)",
+                           [(e['id'], workspace, e['project_id'], e['start'], e['seconds']) 
+                            for e in entries])
+            db.executemany("""INSERT INTO hours VALUES (?, ?, ?, ?)
+                              ON CONFLICT (period, bucket, project_id) 
+                              DO UPDATE SET seconds = seconds + excluded.seconds""",
+                           [(*key, seconds) for key, seconds in deltas.items()])
+
+    def hours(self, period='W'):
+        """Return hours per project for each week ('W') or month ('M')"""
+
+        with closing(self.connect()) as db:
+            hours = pd.read_sql_query("SELECT bucket, project_id, seconds FROM hours "
+                                      "WHERE period = ? AND seconds != 0", db, params=(period,))
+
+        hours['project_id'] = hours['project_id'].mask(hours['project_id'] == no_project)
+        hours['bucket'] = pd.to_datetime(hours['bucket'])
+        hours['hours'] = hours.pop('seconds') / 3600
+
+        return hours
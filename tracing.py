@@ -0,0 +1,98 @@
+"""Lightweight tracing spans for the dashboard's loading stages
+
+Wrap a stage in `with tracing.span('name') as s:` and set s.rows when it
+produces a frame. Every request sent through http_client while the span
+is open is counted against it (and its enclosing spans), along with the
+bytes received and the time lost to retries and backoff. Worker threads
+inherit the submitting thread's spans if their function is wrapped with
+bind(). Finished spans are kept in `finished`, newest last.
+"""
+import contextvars, json, threading, time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import pandas as pd
+
+finished = deque(maxlen=1000)
+
+_open = contextvars.ContextVar('open_spans', default=())
+_lock = threading.Lock()
+
+class Span:
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent.name if parent else None
+        self.started = datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+        self.seconds = 0.
+        self.requests = 0
+        self.retries = 0
+        self.retry_seconds = 0.
+        self.bytes = 0
+        self.rows = None
+
+    def as_dict(self):
+        return dict(vars(self))
+
+@contextmanager
+def span(name):
+    """Time a stage and collect the requests sent while it is open"""
+
+    spans = _open.get()
+    s = Span(name, spans[-1] if spans else None)
+    token = _open.set(spans + (s,))
+    start = time.perf_counter()
+    try:
+        yield s
+    finally:
+        s.seconds = time.perf_counter() - start
+        _open.reset(token)
+        with _lock:
+            finished.append(s)
+
+def bind(func):
+    """Wrap func to run inside the caller's open spans, e.g. on a worker thread"""
+
+    context = contextvars.copy_context()
+    # A context can only be entered by one thread at a time, so copy per call
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+def record(requests=0, retries=0, retry_seconds=0., bytes=0):
+    """Add counts to every open span"""
+
+    with _lock:
+        for s in _open.get():
+            s.requests += requests
+            s.retries += retries
+            s.retry_seconds += retry_seconds
+            s.bytes += bytes
+
+def record_response(response, seconds, streamed=False):
+    """Count a response that took `seconds` in all, including any retries
+
+    A streamed body hasn't been read yet; its reader counts its bytes with
+    record() as they arrive (see http_client.iter_json_array).
+    """
+
+    retry = getattr(response.raw, 'retries', None)
+    retries = len(retry.history) if retry else 0
+    # Everything before the final attempt went to failed attempts and backoff
+    waited = max(seconds - response.elapsed.total_seconds(), 0) if retries else 0.
+
+    size = 0 if streamed else len(response.content)
+    record(requests=1 + retries, retries=retries, retry_seconds=waited, bytes=size)
+
+def snapshot():
+    """Return the finished spans as dicts, copied while no thread is adding to them"""
+
+    with _lock:
+        return [s.as_dict() for s in finished]
+
+def to_frame():
+    """Return the finished spans as a DataFrame"""
+
+    return pd.DataFrame(snapshot(), columns=list(vars(Span(''))))
+
+def to_jsonl():
+    """Return the finished spans as JSON lines"""
+
+    return ''.join(json.dumps(d) + '\n' for d in snapshot())